@@ -0,0 +1,144 @@
+"""
+Load test every route of the API and report throughput and latency
+percentiles as JSON, optionally compared with an earlier run
+
+    python -m benchmarks.bench_api --posts 10000 --concurrency 8 \\
+        --output after.json --compare before.json
+
+Each route is driven in-process through the test client and over HTTP
+through run.py.  Set BENCHMARK_DATABASE_URI to use a local Postgres
+rather than SQLite.
+
+The server run.py starts has no cache (see common.start_server), so over
+HTTP every single post is read from the database, and every page of a list
+counts its posts again for X-Total-Count.  Compare HTTP results with
+earlier HTTP results, not with the in-process ones, which are cached.
+"""
+import argparse
+import itertools
+import json
+import os
+
+import common
+from posts import app
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def scenarios(posts):
+    """
+    The requests to make for each route.  Deletes work through posts which
+    were seeded after the first posts ids, so that every one succeeds.
+    """
+    deletable = itertools.count(posts + 1)
+
+    def post_body(rng):
+        return json.dumps(common.random_post(rng))
+
+    def existing_id(rng):
+        return rng.randint(1, posts)
+
+    return [
+        ("post_get", lambda rng: (
+            "GET", "/api/posts/{}".format(existing_id(rng)), None)),
+        ("posts_get", lambda rng: (
+            "GET", "/api/posts?limit=100&after={}".format(
+                existing_id(rng)), None)),
+        ("posts_get_title_like", lambda rng: (
+            "GET", "/api/posts?limit=100&title_like={}".format(
+                common.zipf_word(rng)), None)),
+        ("posts_get_body_like", lambda rng: (
+            "GET", "/api/posts?limit=100&body_like={}".format(
+                common.zipf_word(rng)), None)),
+        ("posts_get_search", lambda rng: (
+            "GET", "/api/posts?limit=100&q={}".format(
+                common.zipf_word(rng)), None)),
+        ("post_post", lambda rng: ("POST", "/api/posts", post_body(rng))),
+        ("post_put", lambda rng: (
+            "PUT", "/api/posts/{}".format(existing_id(rng)),
+            post_body(rng))),
+        ("post_patch", lambda rng: (
+            "PATCH", "/api/posts/{}".format(existing_id(rng)),
+            json.dumps({"title": common.random_post(rng)["title"]}))),
+        ("post_delete", lambda rng: (
+            "DELETE", "/api/posts/{}".format(next(deletable)), None)),
+    ]
+
+
+def compare(results, baseline):
+    """ Add the change from a baseline run to each result """
+    before = dict(((result["route"], result["transport"]), result)
+                  for result in baseline["results"])
+    for result in results:
+        old = before.get((result["route"], result["transport"]))
+        if old is None:
+            continue
+        result["change"] = dict(
+            (key, result[key] / old[key] - 1 if old[key] else None)
+            for key in ["requests_per_second", "p50_ms", "p95_ms", "p99_ms"]
+            if result[key] is not None and old[key] is not None)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--posts", type=int, default=10000,
+                        help="number of posts to seed")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of clients sending requests at once")
+    parser.add_argument("--requests", type=int, default=1000,
+                        help="number of requests to send to each route")
+    parser.add_argument("--transports", default="client,http",
+                        help="client for the test client, http for run.py")
+    parser.add_argument("--output", help="also write the results here")
+    parser.add_argument("--compare",
+                        help="results of an earlier run to compare with")
+    args = parser.parse_args()
+
+    transports = args.transports.split(",")
+    results = []
+    for transport in transports:
+        # Every transport starts from the same data, with enough extra posts
+        # for the deletes
+        common.reset()
+        common.seed(args.posts + args.requests)
+        server = None
+        if transport == "http":
+            port = common.free_port()
+            server = common.start_server(os.path.join(ROOT, "run.py"), port)
+        try:
+            for route, make_request in scenarios(args.posts):
+                if transport == "http":
+                    samples, failures, elapsed = common.http_load(
+                        port, make_request, args.concurrency, args.requests)
+                else:
+                    samples, failures, elapsed = common.client_load(
+                        app, make_request, args.concurrency, args.requests)
+                result = common.summarize(samples)
+                result.update({
+                    "route": route,
+                    "transport": transport,
+                    "failures": failures,
+                    "requests_per_second": len(samples) / elapsed
+                })
+                results.append(result)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+    common.report({
+        "posts": args.posts,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "database": app.config["DATABASE_URI"].split(":")[0],
+        "results": results
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
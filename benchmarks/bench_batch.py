@@ -0,0 +1,54 @@
+"""
+Compare loading posts one request at a time with /api/posts/batch
+
+    python -m benchmarks.bench_batch --posts 5000 --batch-size 500
+"""
+import argparse
+import json
+import random
+import time
+
+import common
+from posts import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--posts", type=int, default=5000,
+                        help="number of posts to load")
+    parser.add_argument("--batch-size", type=int, default=500,
+                        help="number of posts in each batch request")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    headers = [("Accept", "application/json")]
+    rng = random.Random(0)
+    posts = [common.random_post(rng) for _ in range(args.posts)]
+
+    common.reset()
+    start = time.time()
+    for post in posts:
+        client.post("/api/posts", data=json.dumps(post),
+                    content_type="application/json", headers=headers)
+    single = time.time() - start
+
+    common.reset()
+    start = time.time()
+    for i in range(0, len(posts), args.batch_size):
+        batch = {"create": posts[i:i + args.batch_size]}
+        client.post("/api/posts/batch", data=json.dumps(batch),
+                    content_type="application/json", headers=headers)
+    batched = time.time() - start
+
+    common.report({
+        "posts": args.posts,
+        "batch_size": args.batch_size,
+        "single_posts_per_second": args.posts / single,
+        "batch_posts_per_second": args.posts / batched,
+        "speedup": single / batched
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
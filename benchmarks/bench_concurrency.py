@@ -0,0 +1,57 @@
+"""
+Compare how the threaded development server, the prefork server (run.py)
+and the gevent server (run_gevent.py) cope with many requests in flight at
+once
+
+    python -m benchmarks.bench_concurrency --concurrency 10,100,500
+"""
+import argparse
+import os
+
+import common
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVERS = [("threaded", os.path.join(ROOT, "run.py"),
+            {"SERVER": "development"}),
+           ("prefork", os.path.join(ROOT, "run.py"), {}),
+           ("gevent", os.path.join(ROOT, "run_gevent.py"), {})]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--posts", type=int, default=10000,
+                        help="number of posts to seed")
+    parser.add_argument("--concurrency", default="10,100,500",
+                        help="comma separated numbers of clients")
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="number of requests at each concurrency")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    common.reset()
+    common.seed(args.posts, index=False)
+
+    def make_request(rng):
+        return "GET", "/api/posts/{}".format(rng.randint(1, args.posts)), None
+
+    results = []
+    for name, script, env in SERVERS:
+        port = common.free_port()
+        server = common.start_server(script, port, env)
+        try:
+            for concurrency in [int(c) for c in args.concurrency.split(",")]:
+                samples, failures, elapsed = common.http_load(
+                    port, make_request, concurrency, args.requests)
+                result = common.summarize(samples)
+                result.update({"server": name, "concurrency": concurrency,
+                               "failures": failures,
+                               "requests_per_second": len(samples) / elapsed})
+                results.append(result)
+        finally:
+            server.terminate()
+            server.wait()
+    common.report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+Compare creating posts from many clients at once with a transaction each
+and with group commit
+
+    python -m benchmarks.bench_group_commit --concurrency 32 --requests 5000
+"""
+import argparse
+import json
+
+import common
+from posts import app, group_commit
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="number of clients sending requests at once")
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="number of posts to create in each mode")
+    parser.add_argument("--max-wait-ms", type=int, default=5,
+                        help="longest a write waits for others to join it")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    def make_request(rng):
+        return "POST", "/api/posts", json.dumps(common.random_post(rng))
+
+    results = []
+    for enabled in [False, True]:
+        app.config.update(GROUP_COMMIT_ENABLED=enabled,
+                          GROUP_COMMIT_MAX_WAIT_MS=args.max_wait_ms)
+        group_commit.init_app(app)
+        common.reset()
+        samples, failures, elapsed = common.client_load(
+            app, make_request, args.concurrency, args.requests)
+        result = common.summarize(samples)
+        result.update({"group_commit": enabled, "failures": failures,
+                       "requests_per_second": len(samples) / elapsed})
+        if enabled:
+            result["writes_per_transaction"] = (
+                float(group_commit._committer.writes) /
+                max(group_commit._committer.groups, 1))
+        results.append(result)
+    common.report({"concurrency": args.concurrency, "results": results},
+                  args.output)
+
+
+if __name__ == "__main__":
+    main()
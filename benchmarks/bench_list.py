@@ -0,0 +1,70 @@
+"""
+Compare serializing the post list through ORM objects with the column only
+path used by GET /api/posts, and with a projection to ids and titles as
+used by GET /api/posts?fields=title
+
+    python -m benchmarks.bench_list --posts 100000
+"""
+import argparse
+import json
+import time
+
+import common
+from posts import models, serializers
+from posts.database import session
+
+
+def orm_list():
+    """ How posts_get used to build the list """
+    posts = session.query(models.Post).order_by(models.Post.id).all()
+    return json.dumps([post.as_dictionary() for post in posts])
+
+
+def column_list():
+    """ How posts_get builds the list now """
+    posts = session.query(*models.POST_COLUMNS).order_by(models.Post.id).all()
+    return serializers.dumps([models.row_dictionary(post) for post in posts])
+
+
+def projected_list():
+    """ How posts_get builds the list when only titles are wanted """
+    fields = ("id", "title")
+    posts = session.query(*models.projected_columns(fields)).order_by(
+        models.Post.id).all()
+    return serializers.dumps([models.row_dictionary(post, fields)
+                              for post in posts])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--posts", type=int, default=100000,
+                        help="number of posts to seed")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="number of times to build each list")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    common.reset()
+    common.seed(args.posts, index=False)
+    if orm_list() != column_list():
+        raise SystemExit("The two paths gave different JSON")
+
+    results = {"posts": args.posts, "encoder": serializers.fastjson.__name__}
+    for name, func in [("orm", orm_list), ("columns", column_list),
+                       ("projected", projected_list)]:
+        samples = []
+        for _ in range(args.repeat):
+            # Start each run from an empty identity map
+            session.remove()
+            start = time.time()
+            data = func()
+            samples.append(time.time() - start)
+        results[name + "_rows_per_second"] = args.posts / min(samples)
+        results[name + "_bytes"] = len(data)
+    results["speedup"] = (results["columns_rows_per_second"] /
+                          results["orm_rows_per_second"])
+    common.report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
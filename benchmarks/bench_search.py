@@ -0,0 +1,47 @@
+"""
+Compare the indexed search (q=) with the LIKE '%...%' filters (body_like=)
+
+    python -m benchmarks.bench_search --sizes 10000,100000,1000000
+"""
+import argparse
+
+import common
+from posts import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--sizes", default="10000,100000,1000000",
+                        help="comma separated numbers of posts to seed")
+    parser.add_argument("--ranks", default="1,10,100,1000,10000",
+                        help="frequency ranks of the words to search for")
+    parser.add_argument("--repeat", type=int, default=10,
+                        help="number of times to run each query")
+    parser.add_argument("--limit", type=int, default=20,
+                        help="page size to ask for")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    headers = [("Accept", "application/json")]
+    results = []
+    for size in [int(size) for size in args.sizes.split(",")]:
+        common.reset()
+        common.seed(size)
+        # Common words let LIKE stop early, rare ones make it scan the table
+        for rank in [int(rank) for rank in args.ranks.split(",")]:
+            word = common.VOCABULARY[rank - 1]
+            for name, param in [("like", "body_like"), ("search", "q")]:
+                url = "/api/posts?{}={}&limit={}".format(param, word,
+                                                         args.limit)
+                samples = common.timed(
+                    lambda: client.get(url, headers=headers), args.repeat)
+                result = common.summarize(samples)
+                result.update({"posts": size, "word_rank": rank,
+                               "method": name})
+                results.append(result)
+    common.report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+"""
+Compare reading posts from one database with reading them from shards,
+for single posts routed by id and for pages of the list and search results
+gathered from every shard
+
+    python -m benchmarks.bench_shards --posts 100000 --shards 4
+"""
+import argparse
+import random
+
+import common
+from posts import app, models, search, database, cache
+from posts.database import Base, Session
+
+
+def seed_shards(count, seed=0, batch_size=5000):
+    """ Fill each shard with the posts whose ids hash to it """
+    rng = random.Random(seed)
+    sessions = dict((shard, Session(info={"shard": shard}))
+                    for shard in database.get_shards())
+    for start in range(0, count, batch_size):
+        rows = dict((shard, []) for shard in sessions)
+        for i in range(min(batch_size, count - start)):
+            id = start + i + 1
+            rows[database.shard_for(id)].append(
+                dict(common.random_post(rng), id=id))
+        for shard, shard_rows in rows.items():
+            if not shard_rows:
+                continue
+            shard_session = sessions[shard]
+            shard_session.execute(models.Post.__table__.insert(), shard_rows)
+            terms = [{"term": term, "post_id": row["id"], "weight": weight}
+                     for row in shard_rows
+                     for term, weight in search.term_weights(
+                         row["title"], row["body"]).items()]
+            shard_session.execute(search.terms_table.insert(), terms)
+            shard_session.commit()
+    for shard_session in sessions.values():
+        shard_session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--posts", type=int, default=100000,
+                        help="number of posts to seed")
+    parser.add_argument("--shards", type=int, default=4,
+                        help="number of SQLite files to shard across")
+    parser.add_argument("--requests", type=int, default=2000,
+                        help="number of requests of each kind")
+    parser.add_argument("--concurrency", type=int, default=8,
+                        help="number of clients sending requests at once")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    requests = {
+        "get": lambda rng: ("GET", "/api/posts/{}".format(
+            rng.randint(1, args.posts)), None),
+        "list": lambda rng: ("GET", "/api/posts?limit=50&after={}".format(
+            rng.randint(1, args.posts)), None),
+        "search": lambda rng: ("GET", "/api/posts?limit=50&q={}".format(
+            common.zipf_word(rng)), None)
+    }
+
+    # Measure the databases rather than the cache
+    app.config["CACHE_BACKEND"] = "none"
+    cache.init_app(app)
+
+    results = []
+    for shards in [0, args.shards]:
+        app.config["DATABASE_SHARD_URIS"] = [
+            "sqlite:///posts-benchmark-shard{}.db".format(i)
+            for i in range(shards)]
+        database.configure(app.config)
+        common.reset()
+        if shards:
+            for shard in database.get_shards():
+                Base.metadata.drop_all(shard)
+                Base.metadata.create_all(shard)
+            seed_shards(args.posts)
+        else:
+            common.seed(args.posts)
+        for name, make_request in sorted(requests.items()):
+            samples, failures, elapsed = common.client_load(
+                app, make_request, args.concurrency, args.requests)
+            result = common.summarize(samples)
+            result.update({"shards": shards, "request": name,
+                           "failures": failures,
+                           "requests_per_second": len(samples) / elapsed})
+            results.append(result)
+    common.report({"posts": args.posts, "results": results}, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""
+Measure how long a fresh process takes to import the app and to answer
+its first request
+
+    python -m benchmarks.bench_startup --runs 10
+"""
+import argparse
+import json
+import subprocess
+import sys
+
+import common
+
+# Run in a fresh interpreter each time so nothing is already imported
+PROBE = """
+import json, time
+start = time.time()
+from posts import app
+imported = time.time()
+client = app.test_client()
+client.get("/api/posts/1", headers=[("Accept", "application/json")])
+answered = time.time()
+print(json.dumps({"import": imported - start, "first_request": answered - start}))
+"""
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--runs", type=int, default=10,
+                        help="number of processes to start")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    # The first request needs the tables to exist
+    common.reset()
+    common.seed(10, index=False)
+
+    imports = []
+    first_requests = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, "-c", PROBE])
+        timings = json.loads(output.strip().splitlines()[-1])
+        imports.append(timings["import"])
+        first_requests.append(timings["first_request"])
+
+    common.report({
+        "runs": args.runs,
+        "import": common.summarize(imports),
+        "time_to_first_request": common.summarize(first_requests)
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,55 @@
+"""
+Measure the rate of importing posts through /api/posts/import and exporting
+them again through /api/posts/export
+
+    python -m benchmarks.bench_transfer --posts 100000 --chunk-size 1000
+"""
+import argparse
+import json
+import random
+import time
+
+import common
+from posts import app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--posts", type=int, default=100000,
+                        help="number of posts to import")
+    parser.add_argument("--chunk-size", type=int, default=1000,
+                        help="number of posts committed at a time")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    client = app.test_client()
+    rng = random.Random(0)
+    data = "".join(json.dumps(common.random_post(rng)) + "\n"
+                   for _ in range(args.posts))
+
+    common.reset()
+    start = time.time()
+    response = client.post(
+        "/api/posts/import?chunk_size={}".format(args.chunk_size),
+        data=data, content_type="application/x-ndjson",
+        headers=[("Accept", "application/json")])
+    imported = time.time() - start
+    if json.loads(response.data)["imported"] != args.posts:
+        raise SystemExit("The import failed: {}".format(response.data))
+
+    start = time.time()
+    response = client.get("/api/posts/export",
+                          headers=[("Accept", "application/x-ndjson")])
+    exported = len(response.data.splitlines())
+    elapsed = time.time() - start
+
+    common.report({
+        "posts": args.posts,
+        "chunk_size": args.chunk_size,
+        "import_rows_per_second": args.posts / imported,
+        "export_rows_per_second": exported / elapsed
+    }, args.output)
+
+
+if __name__ == "__main__":
+    main()
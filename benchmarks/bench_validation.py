@@ -0,0 +1,35 @@
+"""
+Compare jsonschema.validate with the precompiled validators used by the API
+
+    python -m benchmarks.bench_validation --number 20000
+"""
+import argparse
+import timeit
+
+import common
+import jsonschema
+from posts import api, validation
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--number", type=int, default=20000,
+                        help="number of validations to time")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    post = {"title": "Example Post", "body": "Just a test"}
+    results = {"validations": args.number}
+    for name, validate in [("jsonschema", jsonschema.validate),
+                           ("precompiled", validation.validate)]:
+        seconds = min(timeit.repeat(
+            lambda: validate(post, api.post_schema),
+            number=args.number, repeat=3))
+        results[name + "_us_per_call"] = 1e6 * seconds / args.number
+    results["speedup"] = (results["jsonschema_us_per_call"] /
+                          results["precompiled_us_per_call"])
+    common.report(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Show how the throughput of run.py grows with the number of worker
+processes, up to the number of CPUs
+
+    python -m benchmarks.bench_workers --workers 1,2,4,8 --concurrency 32
+"""
+import argparse
+import multiprocessing
+import os
+
+import common
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    cpus = multiprocessing.cpu_count()
+    counts = sorted(set([1, 2, 4, cpus]))
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument("--posts", type=int, default=10000,
+                        help="number of posts to seed")
+    parser.add_argument("--workers", default=",".join(map(str, counts)),
+                        help="comma separated numbers of workers")
+    parser.add_argument("--concurrency", type=int, default=32,
+                        help="number of clients sending requests at once")
+    parser.add_argument("--requests", type=int, default=5000,
+                        help="number of requests for each number of workers")
+    parser.add_argument("--output", help="also write the results here")
+    args = parser.parse_args()
+
+    common.reset()
+    common.seed(args.posts, index=False)
+
+    def make_request(rng):
+        return "GET", "/api/posts/{}".format(rng.randint(1, args.posts)), None
+
+    results = []
+    for workers in [int(w) for w in args.workers.split(",")]:
+        port = common.free_port()
+        server = common.start_server(os.path.join(ROOT, "run.py"), port,
+                                     env={"WORKERS": str(workers)})
+        try:
+            samples, failures, elapsed = common.http_load(
+                port, make_request, args.concurrency, args.requests)
+        finally:
+            server.terminate()
+            server.wait()
+        result = common.summarize(samples)
+        result.update({"workers": workers, "failures": failures,
+                       "requests_per_second": len(samples) / elapsed})
+        results.append(result)
+    common.report({"cpus": cpus, "results": results}, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,236 @@
+"""
+Shared helpers for the benchmarks
+
+Importing this module points the app at the benchmark database, so it has to
+be imported before anything from the posts package.  Set
+BENCHMARK_DATABASE_URI to run against something other than a local SQLite
+file.  Servers started by start_server don't cache posts, so that run.py can
+start several workers.
+"""
+import os
+import sys
+import json
+import random
+import socket
+import httplib
+import threading
+import subprocess
+import time
+
+os.environ.setdefault("CONFIG_PATH", "posts.config.BenchmarkConfig")
+
+from posts import models, search
+from posts.database import Base, engine, session
+
+# Synthetic words of a fixed width, so one word is never a substring of
+# another and LIKE and the search index agree about what matches
+VOCABULARY = ["w{:05d}".format(i) for i in range(20000)]
+
+
+def zipf_word(rng):
+    """ Pick a word so that a few are very common and most are rare """
+    return VOCABULARY[min(int(rng.paretovariate(1.0)) - 1,
+                          len(VOCABULARY) - 1)]
+
+
+def random_post(rng, body_words=30):
+    """ Make up a post title and body """
+    title = " ".join(zipf_word(rng) for _ in range(5))
+    body = " ".join(zipf_word(rng) for _ in range(body_words))
+    return {"title": title, "body": body}
+
+
+def reset():
+    """ Drop and recreate every table """
+    session.close()
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+
+
+def seed(count, index=True, seed=0, batch_size=5000):
+    """ Fill the database with count posts, indexing them for search """
+    rng = random.Random(seed)
+    posts_table = models.Post.__table__
+    for start in range(0, count, batch_size):
+        rows = [dict(random_post(rng), id=start + i + 1)
+                for i in range(min(batch_size, count - start))]
+        session.execute(posts_table.insert(), rows)
+        if index:
+            terms = [{"term": term, "post_id": row["id"], "weight": weight}
+                     for row in rows
+                     for term, weight in search.term_weights(
+                         row["title"], row["body"]).items()]
+            session.execute(search.terms_table.insert(), terms)
+        session.commit()
+
+
+def percentile(samples, fraction):
+    """ Nearest rank percentile of a list of numbers """
+    ordered = sorted(samples)
+    if not ordered:
+        return None
+    rank = int(round(fraction * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def summarize(samples):
+    """ Summarize a list of timings in seconds as milliseconds """
+    return {
+        "count": len(samples),
+        "mean_ms": 1000.0 * sum(samples) / len(samples) if samples else None,
+        "p50_ms": 1000.0 * percentile(samples, 0.5) if samples else None,
+        "p95_ms": 1000.0 * percentile(samples, 0.95) if samples else None,
+        "p99_ms": 1000.0 * percentile(samples, 0.99) if samples else None,
+    }
+
+
+def timed(func, repeat):
+    """ Call func repeat times and return the time each call took """
+    samples = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        samples.append(time.time() - start)
+    return samples
+
+
+def report(results, path=None):
+    """ Print results as JSON, and write them to path if one is given """
+    data = json.dumps(results, indent=2, sort_keys=True)
+    print(data)
+    if path:
+        with open(path, "w") as f:
+            f.write(data + "\n")
+
+
+def free_port():
+    """ Find a TCP port which nothing is listening on """
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(script, port, env=None, timeout=30):
+    """
+    Run one of the server scripts on a port against the benchmark database
+    and wait until it accepts connections.  The server has no cache, as
+    run.py's workers can't share the in-process one, so posts are always
+    read from the database and lists count their posts with an uncached
+    COUNT.
+    """
+    environ = dict(os.environ, PORT=str(port), BENCHMARK_CACHE_BACKEND="none",
+                   **(env or {}))
+    process = subprocess.Popen([sys.executable, script], env=environ)
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), 1).close()
+            return process
+        except socket.error:
+            if process.poll() is not None:
+                raise RuntimeError("{} exited early".format(script))
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("{} didn't start listening".format(script))
+
+
+def succeeded(status):
+    """
+    Whether a response counts towards the latencies.  Anything else, such as
+    a 404 or a 412, means the benchmark isn't measuring what it meant to.
+    """
+    return 200 <= status < 300 or status == 304
+
+
+def http_load(port, make_request, concurrency, count):
+    """
+    Send count requests to a server from concurrency threads, each with its
+    own keep-alive connection.  make_request(rng) returns (method, path,
+    body) for the next request.  Returns the latencies of the successful
+    requests, the number of failures, and the total time taken.
+    """
+    samples = []
+    failures = [0]
+    remaining = [count]
+    lock = threading.Lock()
+    headers = {"Accept": "application/json",
+               "Content-Type": "application/json"}
+
+    def worker(seed):
+        rng = random.Random(seed)
+        connection = httplib.HTTPConnection("127.0.0.1", port)
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            method, path, body = make_request(rng)
+            start = time.time()
+            try:
+                connection.request(method, path, body, headers)
+                response = connection.getresponse()
+                response.read()
+                ok = succeeded(response.status)
+            except (socket.error, httplib.HTTPException):
+                connection.close()
+                connection = httplib.HTTPConnection("127.0.0.1", port)
+                ok = False
+            elapsed = time.time() - start
+            with lock:
+                if ok:
+                    samples.append(elapsed)
+                else:
+                    failures[0] += 1
+        connection.close()
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, failures[0], time.time() - start
+
+
+def client_load(app, make_request, concurrency, count):
+    """
+    The same as http_load, but calling the app in-process through its test
+    client rather than over a socket
+    """
+    samples = []
+    failures = [0]
+    remaining = [count]
+    lock = threading.Lock()
+    headers = [("Accept", "application/json")]
+
+    def worker(seed):
+        rng = random.Random(seed)
+        client = app.test_client()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            method, path, body = make_request(rng)
+            start = time.time()
+            response = client.open(path, method=method, data=body,
+                                   content_type="application/json",
+                                   headers=headers)
+            elapsed = time.time() - start
+            with lock:
+                if succeeded(response.status_code):
+                    samples.append(elapsed)
+                else:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,))
+               for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, failures[0], time.time() - start
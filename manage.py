@@ -0,0 +1,97 @@
+"""
+Commands for setting up and maintaining the database, which the app itself
+never does when it starts
+
+    python manage.py initdb
+    python manage.py migrate
+    python manage.py dropdb
+    python manage.py reindex
+    python manage.py prunechanges
+
+initdb only creates tables which don't exist yet, so a database made by an
+older version needs migrate, which also adds the columns the posts table
+has gained since.  Existing posts start at version 1, last updated when the
+migration ran.  Run it before starting the new version of the app, then
+reindex so that the older posts can be searched for.
+"""
+import argparse
+import datetime
+
+from sqlalchemy.engine.reflection import Inspector
+
+from posts import database, models, search, changes
+
+def engines():
+    """ The main database, and every shard if posts are sharded """
+    return [database.engine] + database.get_shards()
+
+def post_sessions():
+    """ A session for each database which holds posts """
+    shards = database.get_shards()
+    if not shards:
+        return [database.session]
+    return [database.Session(info={"shard": shard}) for shard in shards]
+
+def initdb():
+    """ Create any tables which don't exist yet """
+    for engine in engines():
+        database.Base.metadata.create_all(engine)
+
+# Columns added to tables which existed before them, with the definition
+# which adds each one to an existing table
+NEW_COLUMNS = [
+    ("posts", "version", "INTEGER NOT NULL DEFAULT 1"),
+    ("posts", "updated_at", "TIMESTAMP NOT NULL DEFAULT '{now}'")
+]
+
+def migrate():
+    """ Create any new tables, and add any new columns to the old ones """
+    now = datetime.datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    for engine in engines():
+        database.Base.metadata.create_all(engine)
+        inspector = Inspector.from_engine(engine)
+        with engine.begin() as connection:
+            for table, column, definition in NEW_COLUMNS:
+                existing = [existing["name"] for existing
+                            in inspector.get_columns(table)]
+                if column not in existing:
+                    connection.execute("ALTER TABLE {} ADD COLUMN {} {}".
+                                       format(table, column,
+                                              definition.format(now=now)))
+
+def dropdb():
+    """ Drop every table, and all of the posts with them """
+    for engine in engines():
+        database.Base.metadata.drop_all(engine)
+
+def reindex():
+    """ Rebuild the search index from the posts table """
+    for session in post_sessions():
+        search.rebuild(session)
+        session.commit()
+
+def prunechanges():
+    """ Forget changes older than CHANGES_RETENTION_DAYS, seven by default """
+    for session in post_sessions():
+        changes.prune(session,
+                      database.config.get("CHANGES_RETENTION_DAYS", 7))
+        session.commit()
+
+COMMANDS = {
+    "initdb": initdb,
+    "migrate": migrate,
+    "dropdb": dropdb,
+    "reindex": reindex,
+    "prunechanges": prunechanges
+}
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    args = parser.parse_args()
+    COMMANDS[args.command]()
+
+if __name__ == '__main__':
+    main()
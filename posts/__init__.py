@@ -2,12 +2,54 @@ import os
 
 from flask import Flask
 
-app = Flask(__name__)
-config_path = os.environ.get("CONFIG_PATH", "posts.config.DevelopmentConfig")
-app.config.from_object(config_path)
 
-import api
+def create_app(config_path=None):
+    """
+    Build the app from a config object, by default the one named by the
+    CONFIG_PATH environment variable.  Nothing connects to the database until
+    the first request needs it, and no tables are created; use
+    `python manage.py initdb` for that.
 
-from database import Base, engine
-Base.metadata.create_all(engine)
+    The database engines, the cache and the group committer belong to the
+    process rather than to the app, so there can only be one app in use per
+    process.  Building another points every existing app, posts.app
+    included, at the new app's settings; use_app points them back.
+    """
+    app = Flask(__name__)
+    config_path = config_path or os.environ.get(
+        "CONFIG_PATH", "posts.config.DevelopmentConfig")
+    app.config.from_object(config_path)
 
+    import api
+    import cache
+    import compression
+    import database
+    import group_commit
+    import metrics
+
+    database.init_app(app)
+    cache.init_app(app)
+    group_commit.init_app(app)
+    # After request hooks run last first, so this compresses what the
+    # metrics hook leaves
+    compression.init_app(app)
+    metrics.init_app(app)
+    app.register_blueprint(api.api)
+    return app
+
+
+def use_app(app):
+    """
+    Go back to using the database, cache and group commit settings of an app
+    after another has been built
+    """
+    import cache
+    import database
+    import group_commit
+
+    database.configure(app.config)
+    cache.init_app(app)
+    group_commit.init_app(app)
+
+
+app = create_app()
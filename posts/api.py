@@ -1,12 +1,25 @@
-import json
+import time
 
-from flask import request, Response, url_for
-from jsonschema import validate, ValidationError
+from flask import Blueprint, request, Response, url_for, stream_with_context
+from flask import g, current_app
+from sqlalchemy.orm.exc import StaleDataError
 
 import models
 import decorators
-from posts import app
+import search
+import bulk
+import conditional
+import serializers
+import counts
+import database
+import ndjson
+import changes
+import group_commit
+from validation import compile_schema, validate, ValidationError
 from database import session
+from cache import cache, post_key, written_key
+
+api = Blueprint("api", __name__)
 
 # JSON Schema describing the structure of a post
 post_schema = {
@@ -17,14 +30,68 @@ post_schema = {
     "required": ["title", "body"]
 }
 
+# JSON Schema describing a partial update of a post, which has to change
+# something and can't change anything else
+patch_schema = {
+    "type": "object",
+    "properties": post_schema["properties"],
+    "additionalProperties": False,
+    "minProperties": 1
+}
+
+# The most operations of each kind which can be sent in one batch
+MAX_BATCH_SIZE = 1000
+
+# JSON Schema describing a batch of creates, updates and deletes
+batch_schema = {
+    "type": "object",
+    "properties": {
+        "create": {
+            "type": "array",
+            "items": dict(post_schema, type="object"),
+            "maxItems": MAX_BATCH_SIZE
+        },
+        "update": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": dict(post_schema["properties"],
+                                   id={"type": "integer"}),
+                "required": ["id", "title", "body"]
+            },
+            "maxItems": MAX_BATCH_SIZE
+        },
+        "delete": {
+            "type": "array",
+            "items": {"type": "integer"},
+            "maxItems": MAX_BATCH_SIZE
+        }
+    }
+}
+
+# Build the validators up front rather than on the first request
+compile_schema(post_schema)
+compile_schema(patch_schema)
+compile_schema(batch_schema)
+
+# The largest page a client can ask for with the limit parameter
+MAX_PAGE_SIZE = 1000
+# The number of rows fetched from the cursor at a time when streaming
+STREAM_BATCH_SIZE = 1000
+# The number of posts committed at a time by an import
+IMPORT_CHUNK_SIZE = 1000
+# The most changes sent in one response
+MAX_CHANGES = 1000
+
 
-@app.route("/api/posts/<int:id>", methods=["PUT"])
-@decorators.accept("application/json")
-@decorators.require("application/json")
+@api.route("/api/posts/<int:id>", methods=["PUT"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.require(*serializers.MIMETYPES)
+@decorators.shard_by_id
 def post_put(id):
     """ Edit an existing post """
     # Obtain the data passed to the endpoint
-    data = request.json
+    data = serializers.load_request()
 
     # Check that the JSON supplied is valid
     # If not you return a 422 Unprocessable Entity
@@ -32,68 +99,268 @@ def post_put(id):
         validate(data, post_schema)
     except ValidationError as error:
         data = {"message": error.message}
-        return Response(json.dumps(data), 422, mimetype="application/json")
+        return serializers.response(data, 422)
 
-    # Obtain the post to be edited as derived from endpoint
-    post = session.query(models.Post).get(id)
-    # Edit the post
-    post.title = data["title"]
-    post.body = data["body"]
+    return edit_post(id, {"title": data["title"], "body": data["body"]})
+
+
+@api.route("/api/posts/<int:id>", methods=["PATCH"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.require(*serializers.MIMETYPES)
+@decorators.shard_by_id
+def post_patch(id):
+    """ Edit some of the fields of an existing post """
+    data = serializers.load_request()
+
+    # Check that the data supplied is valid
+    # If not you return a 422 Unprocessable Entity
+    try:
+        validate(data, patch_schema)
+    except ValidationError as error:
+        data = {"message": error.message}
+        return serializers.response(data, 422)
+
+    return edit_post(id, data)
+
+
+def edit_post(id, values):
+    """
+    Change the fields of a post with a single UPDATE, which also checks any
+    If-Match header, and return the edited post
+    """
+    versions = conditional.matching_versions(id)
+    if group_commit.enabled():
+        return group_committed(group_commit.submit("update", values, id,
+                                                   versions))
+
+    post = bulk.update_post(session, id, values, versions)
+    if post is None:
+        # Only now find out whether the post is missing or has moved on
+        exists = session.query(models.Post.id).filter(
+            models.Post.id == id).first()
+        session.rollback()
+        if exists is None:
+            message = "Could not find post with id {}".format(id)
+            return serializers.response({"message": message}, 404)
+        return conditional.precondition_failed_response(id)
+    search.index_post(session, post.id, post.title, post.body)
     session.commit()
-    # Return a 200 OK, containing the post as JSON and with the
-    # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
-    headers = {"Location": url_for("post_get", id=post.id)}
-    return Response(data, 200, headers=headers,
-                    mimetype="application/json")
+    uncache(id)
+    return saved_response(post, 200)
+
+
+def group_committed(write):
+    """ The response to a create or edit committed as part of a group """
+    if write.status == 404:
+        message = "Could not find post with id {}".format(write.post_id)
+        return serializers.response({"message": message}, 404)
+    if write.status == 412:
+        return conditional.precondition_failed_response(write.post_id)
+    if write.status == 500:
+        return serializers.response({"message": "Could not save post"}, 500)
+    if write.op == "update":
+        uncache(write.post.id)
+    return saved_response(write.post, write.status)
 
 
-@app.route("/api/posts", methods=["POST"])
-@decorators.accept("application/json")
-@decorators.require("application/json")
+def saved_response(post, status):
+    """
+    A response containing a post which has just been saved, given its row
+    of bulk.UPDATED_COLUMNS
+    """
+    # Return the post, with the Location header set to the location of the
+    # post
+    headers = {"Location": url_for(".post_get", id=post.id)}
+    response = serializers.response(models.row_dictionary(post), status,
+                                    headers=headers)
+    return conditional.add_validators(
+        response, conditional.post_etag(post.id, post.version),
+        post.updated_at)
+
+
+@api.route("/api/posts", methods=["POST"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.require(*serializers.MIMETYPES)
 def post_post():
     """ Add a new post """
-    data = request.json
+    data = serializers.load_request()
     # Check that the JSON supplied is valid
     # If not you return a 422 Unprocessable Entity
     try:
         validate(data, post_schema)
     except ValidationError as error:
         data = {"message": error.message}
-        return Response(json.dumps(data), 422, mimetype="application/json")
+        return serializers.response(data, 422)
+    if group_commit.enabled():
+        return group_committed(group_commit.submit(
+            "create", {"title": data["title"], "body": data["body"]}))
     # Add the post to the database
-    post = models.Post(title=data["title"], body=data["body"])
+    # Sharded posts are numbered up front, so we know which shard to use
+    post = models.Post(id=database.new_id(), title=data["title"],
+                       body=data["body"])
+    database.use_shard(post.id)
     session.add(post)
+    # Flush so that the post has an id to index it under
+    session.flush()
+    search.index_post(session, post.id, post.title, post.body)
+    changes.record(session, "create", [post.id])
     session.commit()
-    # Return a 201 Created, containing the post as JSON and with the
+    # Return a 201 Created, containing the post and with the
     # Location header set to the location of the post
-    data = json.dumps(post.as_dictionary())
-    headers = {"Location": url_for("post_get", id=post.id)}
-    return Response(data, 201, headers=headers,
-                    mimetype="application/json")
+    headers = {"Location": url_for(".post_get", id=post.id)}
+    response = serializers.response(post.as_dictionary(), 201,
+                                    headers=headers)
+    return conditional.add_validators(
+        response, conditional.post_etag(post.id, post.version),
+        post.updated_at)
+
+
+@api.route("/api/posts/batch", methods=["POST"])
+@decorators.unsharded
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.require(*serializers.MIMETYPES)
+def posts_batch():
+    """ Create, edit and delete many posts in a single transaction """
+    data = serializers.load_request()
+
+    # Check the whole batch in one go
+    # If any of it is invalid return a 422 and don't touch the database
+    try:
+        validate(data, batch_schema)
+    except ValidationError as error:
+        path = "/".join(str(part) for part in error.path)
+        data = {"message": error.message, "path": path}
+        return serializers.response(data, 422)
+    creates = data.get("create", [])
+    updates = data.get("update", [])
+    deletes = data.get("delete", [])
+
+    # Edits and deletes of posts which don't exist are reported as 404s
+    found = bulk.existing_ids(session, [post["id"] for post in updates] +
+                              deletes)
+
+    ids = bulk.insert_posts(session, creates)
+    bulk.update_posts(session, [post for post in updates
+                                if post["id"] in found])
+    bulk.delete_posts(session, [id for id in deletes if id in found])
+    session.commit()
+    uncache(*found)
+
+    # Return a 200 OK with a result for each item in the batch
+    data = {
+        "create": [batch_result(id, 201) for id in ids],
+        "update": [batch_result(post["id"], 200) if post["id"] in found
+                   else batch_not_found(post["id"]) for post in updates],
+        "delete": [batch_deleted(id) if id in found else batch_not_found(id)
+                   for id in deletes]
+    }
+    return serializers.response(data, 200)
+
 
+def batch_result(id, status):
+    """ The result of creating or editing a post in a batch """
+    return {"id": id, "status": status,
+            "location": url_for(".post_get", id=id)}
 
-@app.route("/api/posts/<int:id>", methods=["GET"])
-@decorators.accept("application/json")
+
+def batch_deleted(id):
+    """ The result of deleting a post in a batch """
+    message = "Deleted post with id {}".format(id)
+    return {"id": id, "status": 200, "message": message}
+
+
+def batch_not_found(id):
+    """ The result of trying to edit or delete a missing post in a batch """
+    message = "Could not find post with id {}".format(id)
+    return {"id": id, "status": 404, "message": message}
+
+
+@api.route("/api/posts/<int:id>", methods=["GET"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.shard_by_id
+@decorators.read_replica
 def post_get(id):
     """ Single post endpoint """
-    # Get the post from the database
-    post = session.query(models.Post).get(id)
+    # Check the projection arguments
+    # If they are invalid return a 400 Bad Request
+    try:
+        projection = projection_args()
+    except ValueError as error:
+        return serializers.response({"message": str(error)}, 400)
+    if projection is not None:
+        return projected_post(id, *projection)
+
+    # Serve the post from the cache if we can
+    written, new = last_written(id)
+    key = post_key(id, written, serializers.current().mimetype)
+    cached = cache.get(key)
+    if cached is None and (request.if_none_match or
+                           request.if_modified_since):
+        # Check whether the client's copy is current before loading the body
+        version = session.query(models.Post.version,
+                                models.Post.updated_at).filter(
+            models.Post.id == id).first()
+        if version is not None:
+            etag = conditional.post_etag(id, version[0])
+            if conditional.not_modified(etag, version[1]):
+                return conditional.not_modified_response(etag, version[1])
+
+    if cached is None:
+        # Get the post from the database
+        post = session.query(models.Post).get(id)
+
+        # Check whether the post exists
+        # If not return a 404 with a helpful message
+        if not post:
+            if new:
+                # Don't keep anything about ids which have no post
+                cache.delete(written_key(id))
+            message = "Could not find post with id {}".format(id)
+            return serializers.response({"message": message}, 404)
+
+        # Keep the serialized post and its validators for next time, unless
+        # it came from a replica which may not have the latest write yet
+        cached = (serializers.dumps(post.as_dictionary()),
+                  conditional.post_etag(post.id, post.version),
+                  post.updated_at)
+        if written / 1000000.0 + database.replica_lag() < time.time():
+            cache.set(key, cached)
+
+    # Return the post, or nothing if the client is up to date
+    data, etag, last_modified = cached
+    if conditional.not_modified(etag, last_modified):
+        return conditional.not_modified_response(etag, last_modified)
+    response = Response(data, 200, mimetype=serializers.current().mimetype)
+    return conditional.add_validators(response, etag, last_modified)
+
+
+def projected_post(id, fields, columns, etag_suffix):
+    """
+    Send some of the fields of a post.  Only the columns for those fields are
+    read, and the result isn't cached.
+    """
+    post = session.query(*(columns + (models.Post.version,
+                                      models.Post.updated_at))).filter(
+        models.Post.id == id).first()
 
     # Check whether the post exists
     # If not return a 404 with a helpful message
     if not post:
         message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
+        return serializers.response({"message": message}, 404)
 
-    # Return the post as JSON
-    data = json.dumps(post.as_dictionary())
-    return Response(data, 200, mimetype="application/json")
+    # Each projection is a different representation with its own ETag
+    etag = conditional.with_suffix(conditional.post_etag(id, post.version),
+                                   etag_suffix)
+    if conditional.not_modified(etag, post.updated_at):
+        return conditional.not_modified_response(etag, post.updated_at)
+    response = serializers.response(models.row_dictionary(post, fields), 200)
+    return conditional.add_validators(response, etag, post.updated_at)
 
 
-@app.route("/api/posts/<int:id>", methods=["DELETE"])
-@decorators.accept("application/json")
+@api.route("/api/posts/<int:id>", methods=["DELETE"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.shard_by_id
 def post_delete(id):
     """ Delete a post """
      # Get the post from the database
@@ -103,40 +370,411 @@ def post_delete(id):
     # If not return a 404 with a helpful message
     if not post:
         message = "Could not find post with id {}".format(id)
-        data = json.dumps({"message": message})
-        return Response(data, 404, mimetype="application/json")
+        return serializers.response({"message": message}, 404)
+
+    # If the client said which version it is deleting check that it is
+    # still the current one
+    if conditional.precondition_failed(post.id, post.version):
+        return conditional.precondition_failed_response(id)
 
     # If it does exist, delete it
+    search.unindex_post(session, post.id)
+    changes.record(session, "delete", [post.id])
     session.delete(post)
-    session.commit()
+    # Someone else may have edited the post since we read it
+    try:
+        session.commit()
+    except StaleDataError:
+        session.rollback()
+        return conditional.precondition_failed_response(id)
+    uncache(id)
 
     # Return success message/code
     message = "Deleted post with id {}".format(id)
-    data = json.dumps({"message": message})
-    return Response(data, 200, mimetype="application/json")
+    return serializers.response({"message": message}, 200)
 
 
-@app.route("/api/posts", methods=["GET"])
-@decorators.accept("application/json")
+@api.route("/api/posts", methods=["GET"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.read_replica
 def posts_get():
     """ Get a list of posts """
     # Get the querystring arguments
     title_like = request.args.get("title_like")
     body_like = request.args.get("body_like")
+    q = request.args.get("q")
+    stream = request.args.get("stream") in ("1", "true")
+
+    # Check that the paging arguments are positive integers
+    # If not return a 400 Bad Request
+    try:
+        limit = positive_int_arg("limit", maximum=MAX_PAGE_SIZE)
+        after = positive_int_arg("after")
+        after_rank = positive_int_arg("after_rank")
+        if q and after is not None and after_rank is None:
+            raise ValueError("after_rank is required to page through q")
+        projection = projection_args()
+    except ValueError as error:
+        return serializers.response({"message": str(error)}, 400)
 
     # Construct a query without actually hitting the DB
-    posts = session.query(models.Post)
+    # Selecting plain columns skips building an ORM object for every row,
+    # and lets the client skip reading the columns it doesn't want
+    fields, columns = None, models.POST_COLUMNS
+    if projection is not None:
+        fields, columns, _ = projection
+    posts, ranking = filter_posts(session.query(*columns), q, title_like,
+                                  body_like)
+    if posts is None:
+        return serializers.response([], 200, headers={"X-Total-Count": "0"})
+    # Everything the filters match, whichever page is asked for
+    matching = posts
+    if q:
+        # Search results come from the index, best matches first
+        posts = posts.order_by(ranking.c.rank.desc(), models.Post.id)
+        # Only return posts which come after the cursor
+        if after is not None:
+            posts = posts.filter(search.after_cursor(ranking, after_rank,
+                                                     after))
+        key = lambda post: (-post.rank, post.id)
+    else:
+        # Ordering by id gives us a stable key to page on
+        posts = posts.order_by(models.Post.id)
+        # Only return posts which come after the cursor
+        if after is not None:
+            posts = posts.filter(models.Post.id > after)
+        key = lambda post: post.id
+
+    # Tell the client how many posts there are on every page
+    total = counts.count(matching, (q, title_like, body_like))
+    headers = {"X-Total-Count": str(total)}
+
+    # Keep hold of the search ranks, which the shards' results are merged by
+    if q:
+        posts = posts.add_columns(ranking.c.rank)
+
+    # Stream the rows out of a server side cursor as they arrive.  There is
+    # no ETag, as that would mean reading every row before sending any.
+    if stream:
+        if limit is not None:
+            posts = posts.limit(limit)
+        # Keep the request context, and so the session, until it finishes
+        return Response(
+            stream_with_context(stream_posts(posts, key, fields)), 200,
+            headers=headers, mimetype=serializers.current().mimetype)
+
+    # Execute the query on the DB, or on every shard at once, fetching one
+    # extra row so we know whether there is a next page
+    posts = database.gather(posts.add_columns(models.Post.version), key,
+                            None if limit is None else limit + 1)
+
+    # The list's ETag comes from the rows just fetched and the total, so
+    # checking it costs no more than the page itself.  Deleting a post
+    # doesn't move any timestamp forward, so lists only get an ETag.
+    etag = conditional.list_etag(total, *[
+        (post.id, post.version, getattr(post, "rank", None))
+        for post in posts])
+    if conditional.not_modified(etag):
+        return conditional.not_modified_response(etag)
+
+    # If there is a next page point the client at it with a Link header
+    if limit is not None and len(posts) > limit:
+        posts = posts[:limit]
+        args = request.args.to_dict()
+        args["after"] = posts[-1].id
+        if q:
+            args["after_rank"] = posts[-1].rank
+        headers["Link"] = '<{}>; rel="next"'.format(
+            url_for(".posts_get", _external=True, **args))
+
+    # Serialize the posts and return a response
+    response = serializers.response(
+        [models.row_dictionary(post, fields) for post in posts], 200,
+        headers=headers)
+    return conditional.add_validators(response, etag)
+
+
+@api.route("/api/posts/count", methods=["GET"])
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.read_replica
+def posts_count():
+    """ Count the posts matching the same filters as the list of posts """
+    title_like = request.args.get("title_like")
+    body_like = request.args.get("body_like")
+    q = request.args.get("q")
+
+    posts, _ = filter_posts(session.query(models.Post.id), q, title_like,
+                            body_like)
+    count = 0
+    if posts is not None:
+        count = counts.count(posts, (q, title_like, body_like))
+    return serializers.response({"count": count}, 200)
+
+
+@api.route("/api/posts/export", methods=["GET"])
+@decorators.accept(ndjson.MIMETYPE)
+@decorators.read_replica
+def posts_export():
+    """
+    Stream every post as NDJSON in id order.  An interrupted export can be
+    picked up with after set to the last id received.
+    """
+    try:
+        after = positive_int_arg("after")
+    except ValueError as error:
+        return serializers.response({"message": str(error)}, 400)
+
+    posts = session.query(*models.POST_COLUMNS).order_by(models.Post.id)
+    if after is not None:
+        posts = posts.filter(models.Post.id > after)
+    # Read from a server side cursor, so memory use doesn't grow with the
+    # number of posts
+    posts = posts.execution_options(stream_results=True).yield_per(
+        STREAM_BATCH_SIZE)
+    rows = (models.row_dictionary(post) for post in database.merged(
+        posts, lambda post: post.id))
+    return Response(stream_with_context(ndjson.stream(rows)), 200,
+                    mimetype=ndjson.MIMETYPE)
+
+
+@api.route("/api/posts/import", methods=["POST"])
+@decorators.unsharded
+@decorators.accept(*serializers.MIMETYPES)
+@decorators.require(ndjson.MIMETYPE)
+def posts_import():
+    """
+    Create posts from a stream of NDJSON, validating and committing a chunk
+    at a time.  With an import_id each chunk records how far through the
+    stream it got in the same transaction, so that sending the same stream
+    again with the same import_id carries on after the last chunk committed.
+    """
+    import_id = request.args.get("import_id")
+    try:
+        chunk_size = positive_int_arg("chunk_size", maximum=MAX_BATCH_SIZE)
+    except ValueError as error:
+        return serializers.response({"message": str(error)}, 400)
+
+    checkpoint = None
+    if import_id is not None:
+        checkpoint = bulk.get_checkpoint(session, import_id)
+    skipped = checkpoint or 0
+    imported = 0
+    start = time.time()
+    data = {}
+    status = 200
+    try:
+        for chunk in ndjson.chunks(request.stream,
+                                   chunk_size or IMPORT_CHUNK_SIZE, skipped):
+            # Check the whole chunk before writing any of it
+            for number, post in chunk:
+                if not isinstance(post, dict):
+                    raise ValueError("Line {} is not an object".format(number))
+                try:
+                    validate(post, post_schema)
+                except ValidationError as error:
+                    raise ValueError("Line {}: {}".format(number,
+                                                          error.message))
+            ids = bulk.load_posts(session, [post for _, post in chunk])
+            last = chunk[-1][0]
+            if import_id is not None:
+                if not bulk.move_checkpoint(session, import_id, checkpoint,
+                                            last):
+                    session.rollback()
+                    message = "Import {} is already running".format(import_id)
+                    data, status = {"message": message}, 409
+                    break
+                checkpoint = last
+            session.commit()
+            imported += len(ids)
+    except ValueError as error:
+        # Earlier chunks stay committed, and the checkpoint says where to
+        # carry on from once the data is fixed
+        session.rollback()
+        data, status = {"message": str(error)}, 422
+
+    elapsed = time.time() - start
+    data.update({
+        "imported": imported,
+        "checkpoint": checkpoint,
+        "seconds": elapsed,
+        "rows_per_second": imported / elapsed if elapsed else None
+    })
+    return serializers.response(data, status)
+
+
+@api.route("/api/posts/changes", methods=["GET"])
+@decorators.unsharded
+@decorators.accept(*(serializers.MIMETYPES + (changes.EVENT_STREAM,)))
+@decorators.read_replica
+def posts_changes():
+    """
+    The changes to posts after the one numbered since, oldest first.  With
+    wait=N the response is held for up to N seconds until there are some.
+    Clients which accept text/event-stream get a stream of Server-Sent
+    Events instead, which carries on as changes are made.
+    """
+    config = current_app.config
+    since = request.args.get("since", request.headers.get("Last-Event-ID"))
+    try:
+        since = int(since or 0)
+        if since < 0:
+            raise ValueError()
+    except ValueError:
+        message = "since must be a non-negative integer"
+        return serializers.response({"message": message}, 400)
+    try:
+        limit = positive_int_arg("limit", maximum=MAX_CHANGES)
+        wait = positive_int_arg("wait",
+                                maximum=config.get("CHANGES_MAX_WAIT", 30))
+    except ValueError as error:
+        return serializers.response({"message": str(error)}, 400)
+    limit = limit or MAX_CHANGES
+    poll_interval = config.get("CHANGES_POLL_INTERVAL", 1.0)
+
+    if g.response_mimetype == changes.EVENT_STREAM:
+        # Keep the request context, and so the session, until it finishes
+        response = Response(stream_with_context(
+            stream_changes(since, limit, poll_interval)), 200,
+            mimetype=changes.EVENT_STREAM)
+        response.headers["Cache-Control"] = "no-cache"
+        return response
+
+    if wait:
+        found = changes.wait(session, since, limit, wait, poll_interval)
+    else:
+        found = changes.read(session, since, limit)
+    # The number to send as since next time
+    last = found[-1]["seq"] if found else since
+    return serializers.response({"changes": found, "last": last}, 200)
+
+
+def stream_changes(since, limit, poll_interval):
+    """
+    Generate Server-Sent Events for changes as they are made, with a comment
+    every CHANGES_HEARTBEAT seconds so that proxies keep the connection
+    open.  The stream ends after CHANGES_STREAM_SECONDS, and the client
+    reconnects with the Last-Event-ID it was sent.
+    """
+    config = current_app.config
+    heartbeat = config.get("CHANGES_HEARTBEAT", 15)
+    deadline = time.time() + config.get("CHANGES_STREAM_SECONDS", 300)
+    while time.time() < deadline:
+        found = changes.wait(session, since, limit,
+                             min(heartbeat, deadline - time.time()),
+                             poll_interval)
+        if not found:
+            yield ": keep-alive\n\n"
+            continue
+        for change in found:
+            yield "id: {}\nevent: change\ndata: {}\n\n".format(
+                change["seq"], serializers.fastjson.dumps(change))
+        since = found[-1]["seq"]
+
+
+def filter_posts(posts, q, title_like, body_like):
+    """
+    Narrow a query down to the posts matching the search and filter
+    arguments.  Returns the query and the search ranking it was joined to,
+    if any.  The query is None if the search can't match anything.
+    """
+    ranking = None
+    if q:
+        # Search results come from the index
+        ranking = search.ranked(session, q)
+        if ranking is None:
+            return None, None
+        posts = posts.join(ranking, ranking.c.post_id == models.Post.id)
     # If the query string contained a title_like, add that filter
     if title_like:
         posts = posts.filter(models.Post.title.contains(title_like))
     # If the query string contained a body_like, add that filter
     if body_like:
         posts = posts.filter(models.Post.body.contains(body_like))
-    # Execute the query on the DB
-    posts = posts.all()
+    return posts, ranking
+
+
+def positive_int_arg(name, maximum=None):
+    """ Read an optional positive integer from the querystring """
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        value = 0
+    if value < 1:
+        raise ValueError("{} must be a positive integer".format(name))
+    if maximum is not None and value > maximum:
+        raise ValueError("{} must be at most {}".format(name, maximum))
+    return value
+
+
+def projection_args():
+    """
+    Read the fields and body_preview arguments from the querystring.  Returns
+    None if the client wants whole posts, or the fields to send, the columns
+    to select for them and a suffix telling their entity tags apart.
+    """
+    fields = request.args.get("fields")
+    body_preview = positive_int_arg("body_preview")
+    if fields is None and body_preview is None:
+        return None
+    requested = models.FIELDS
+    if fields is not None:
+        requested = [field.strip() for field in fields.split(",")
+                     if field.strip()]
+        for field in requested:
+            if field not in models.FIELDS:
+                raise ValueError("Unknown field {}".format(field))
+    # The id is always sent so that clients can page and link to posts
+    fields = tuple(field for field in models.FIELDS
+                   if field == "id" or field in requested)
+    etag_suffix = ".".join(fields)
+    if body_preview is not None and "body" in fields:
+        etag_suffix += ".{}".format(body_preview)
+    return (fields, models.projected_columns(fields, body_preview),
+            etag_suffix)
+
+
+def stream_posts(posts, key, fields=None):
+    """
+    Serialize posts one row at a time so that memory use doesn't grow with
+    the size of the result.  Sharded posts are merged by key as they arrive.
+    """
+    posts = posts.execution_options(stream_results=True).yield_per(
+        STREAM_BATCH_SIZE)
+    return serializers.stream(models.row_dictionary(post, fields)
+                              for post in database.merged(posts, key))
+
 
-    # Convert the posts to JSON and return a response
-    data = json.dumps([post.as_dictionary() for post in posts])
-    return Response(data, 200, mimetype="application/json")
+def last_written(id):
+    """
+    When a post was last written, in microseconds, which is part of the key
+    its cached copies are kept under, and whether that has just been decided.
+    A post the cache knows nothing about is taken to have been written now,
+    so that copies cached before the cache forgot about it aren't used.  That
+    is stored before the post is read, so that a write which comes in
+    between moves its copies on to a later key.
+    """
+    key = written_key(id)
+    written = cache.get(key)
+    if written is not None:
+        return written, False
+    written = int(time.time() * 1000000)
+    cache.set(key, written)
+    return written, True
 
 
+def uncache(*ids):
+    """
+    Forget the cached copies of posts, in every representation, by moving
+    them on to new keys.  A copy which a request read before the write and
+    caches after it goes under the old key, so it is never served.  The time
+    of the write also stops a replica which hasn't caught up with it putting
+    the old post back.
+    """
+    now = int(time.time() * 1000000)
+    for id in ids:
+        key = written_key(id)
+        # Make sure the key changes, however close together the writes are
+        cache.set(key, max(now, (cache.get(key) or 0) + 1))
@@ -0,0 +1,178 @@
+import csv
+import datetime
+from io import BytesIO
+
+from sqlalchemy import bindparam, select, text
+from sqlalchemy.exc import IntegrityError
+
+import models
+import search
+import changes
+
+posts_table = models.Post.__table__
+checkpoints_table = models.ImportCheckpoint.__table__
+# The columns of a post which a single post update hands back
+UPDATED_COLUMNS = (posts_table.c.id, posts_table.c.title, posts_table.c.body,
+                   posts_table.c.version, posts_table.c.updated_at)
+
+
+def existing_ids(session, post_ids):
+    """ Return the set of ids from a list which belong to existing posts """
+    if not post_ids:
+        return set()
+    rows = session.query(models.Post.id).filter(models.Post.id.in_(post_ids))
+    return set(post_id for post_id, in rows)
+
+
+def insert_posts(session, posts):
+    """
+    Insert a list of post dictionaries and index them for search, returning
+    the new ids in the same order
+    """
+    if not posts:
+        return []
+    rows = [{"title": post["title"], "body": post["body"]} for post in posts]
+    if session.get_bind().dialect.implicit_returning:
+        # One multi-row INSERT ... RETURNING id
+        statement = posts_table.insert().values(rows).returning(
+            posts_table.c.id)
+        ids = [post_id for post_id, in session.execute(statement)]
+    else:
+        # Without RETURNING each row has to be inserted on its own to find
+        # out its id, but they still share a transaction
+        ids = [session.execute(posts_table.insert(), row)
+               .inserted_primary_key[0] for row in rows]
+    search.index_posts(session, [dict(row, id=post_id)
+                                 for row, post_id in zip(rows, ids)])
+    changes.record(session, "create", ids)
+    return ids
+
+
+def copy_posts(session, posts):
+    """
+    Load a list of post dictionaries with COPY, the fastest way into
+    Postgres, and index them for search, returning the new ids in the same
+    order.  COPY can't hand back ids, so they are taken from the table's
+    sequence up front.
+    """
+    if not posts:
+        return []
+    ids = [post_id for post_id, in session.execute(
+        text("SELECT nextval(:sequence) FROM generate_series(1, :count)"),
+        {"sequence": "{}_id_seq".format(posts_table.name),
+         "count": len(posts)})]
+    now = datetime.datetime.utcnow().isoformat()
+    data = BytesIO()
+    writer = csv.writer(data)
+    for post_id, post in zip(ids, posts):
+        writer.writerow([post_id, post["title"].encode("utf-8"),
+                         post["body"].encode("utf-8"), 1, now])
+    data.seek(0)
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(
+            "COPY {} (id, title, body, version, updated_at) FROM STDIN "
+            "WITH CSV".format(posts_table.name), data)
+    finally:
+        cursor.close()
+    search.index_posts(session, [{"id": post_id, "title": post["title"],
+                                  "body": post["body"]}
+                                 for post_id, post in zip(ids, posts)])
+    changes.record(session, "create", ids)
+    return ids
+
+
+def load_posts(session, posts):
+    """
+    Insert a list of post dictionaries by the fastest means the database
+    has, returning the new ids in the same order
+    """
+    if session.get_bind().dialect.name == "postgresql":
+        return copy_posts(session, posts)
+    return insert_posts(session, posts)
+
+
+def update_posts(session, posts):
+    """
+    Update a list of post dictionaries, which have to exist, in a single
+    executemany and reindex them for search
+    """
+    if not posts:
+        return
+    statement = posts_table.update().where(
+        posts_table.c.id == bindparam("post_id")).values(
+        title=bindparam("new_title"), body=bindparam("new_body"),
+        version=posts_table.c.version + 1)
+    session.execute(statement, [{"post_id": post["id"],
+                                 "new_title": post["title"],
+                                 "new_body": post["body"]}
+                                for post in posts])
+    search.index_posts(session, posts)
+    changes.record(session, "update", [post["id"] for post in posts])
+
+
+def update_post(session, post_id, values, versions=None):
+    """
+    Set some of the fields of a post and bump its version in one UPDATE,
+    returning the new row of UPDATED_COLUMNS.  If versions is given the post
+    is only changed if it is at one of them.  Returns None if no post was
+    changed, either because it doesn't exist or because it is at another
+    version.
+    """
+    statement = posts_table.update().where(
+        posts_table.c.id == post_id).values(
+        version=posts_table.c.version + 1, **values)
+    if versions is not None:
+        if not versions:
+            return None
+        statement = statement.where(posts_table.c.version.in_(versions))
+    if session.get_bind().dialect.implicit_returning:
+        # UPDATE ... RETURNING hands back the new row in the same round trip
+        post = session.execute(statement.returning(*UPDATED_COLUMNS)).first()
+    elif session.execute(statement).rowcount == 1:
+        # Otherwise read the row back in the same transaction
+        post = session.execute(select(UPDATED_COLUMNS).where(
+            posts_table.c.id == post_id)).first()
+    else:
+        post = None
+    if post is not None:
+        changes.record(session, "update", [post_id])
+    return post
+
+
+def delete_posts(session, post_ids):
+    """ Delete a list of posts in one statement and remove them from search """
+    if not post_ids:
+        return
+    search.unindex_posts(session, post_ids)
+    session.execute(posts_table.delete().where(
+        posts_table.c.id.in_(post_ids)))
+    changes.record(session, "delete", post_ids)
+
+
+def get_checkpoint(session, import_id):
+    """
+    Return the number of lines of an import which have been committed, or
+    None if it hasn't been started
+    """
+    return session.execute(select([checkpoints_table.c.lines]).where(
+        checkpoints_table.c.id == import_id)).scalar()
+
+
+def move_checkpoint(session, import_id, old, new):
+    """
+    Move an import's checkpoint from old lines, or None if it hasn't been
+    started, to new lines.  Returns False if another request running the
+    same import got there first.
+    """
+    if old is None:
+        try:
+            session.execute(checkpoints_table.insert().values(
+                id=import_id, lines=new))
+        except IntegrityError:
+            return False
+        return True
+    return session.execute(checkpoints_table.update().where(
+        (checkpoints_table.c.id == import_id) &
+        (checkpoints_table.c.lines == old)).values(
+        lines=new)).rowcount == 1
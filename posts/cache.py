@@ -0,0 +1,283 @@
+import time
+import cPickle as pickle
+import threading
+from collections import OrderedDict
+
+from werkzeug.local import LocalProxy
+from werkzeug.utils import import_string
+
+# What the keys of cached posts start with
+POST_PREFIX = "post:"
+
+
+class Cache(object):
+    """
+    Interface for caches of serialized responses
+
+    Values are anything which can be pickled.  Every cache counts its
+    evictions, and the hits and misses of lookups of cached posts; the
+    bookkeeping kept alongside them, such as when each post was written, is
+    looked up on nearly every request and isn't counted.
+    """
+    # Whether other processes see what is stored
+    shared = False
+    # Whether what is stored is only seen by this process, so that several
+    # processes serving the same posts would disagree about them
+    per_process = False
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Return the value stored under key, or None """
+        raise NotImplementedError
+
+    def lookup(self, key, found):
+        """ Count a lookup of key as a hit or a miss, if it was of a post """
+        if not key.startswith(POST_PREFIX):
+            return
+        if found:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    def set(self, key, value):
+        """ Store value under key """
+        raise NotImplementedError
+
+    def delete(self, key):
+        """ Forget anything stored under key """
+        raise NotImplementedError
+
+    def incr(self, key, delta=1):
+        """
+        Add delta to the integer stored under key and return the result, or
+        return None if nothing is stored there
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Forget everything """
+        raise NotImplementedError
+
+    def stats(self):
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+class NullCache(Cache):
+    """ A cache which never stores anything """
+    def get(self, key):
+        self.lookup(key, False)
+        return None
+
+    def set(self, key, value):
+        pass
+
+    def delete(self, key):
+        pass
+
+    def incr(self, key, delta=1):
+        return None
+
+    def clear(self):
+        pass
+
+
+class LRUCache(Cache):
+    """
+    An in-process cache which holds at most max_size values, dropping the
+    least recently used first, and forgets values after ttl seconds
+    """
+    per_process = True
+
+    def __init__(self, max_size=1024, ttl=60):
+        super(LRUCache, self).__init__()
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is None or item[0] < time.time():
+                self.lookup(key, False)
+                return None
+            # Move the item to the most recently used end
+            self.items[key] = item
+            self.lookup(key, True)
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items.pop(key, None)
+            self.items[key] = (time.time() + self.ttl, value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[0] < time.time():
+                return None
+            self.items[key] = (item[0], item[1] + delta)
+            return item[1] + delta
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+    def stats(self):
+        stats = super(LRUCache, self).stats()
+        stats["size"] = len(self.items)
+        return stats
+
+
+class SharedCache(Cache):
+    """
+    A cache kept in a store shared between processes
+
+    The client needs get(key), set(key, value, ttl), delete(key),
+    incr(key, delta) and clear() methods, which are easy to provide on top of
+    memcached or redis.  The store does its own evicting, so evictions aren't
+    counted here.  A client which only keeps things in the current process
+    sets per_process to True.
+
+    Integers are stored as plain decimal strings rather than pickled, so that
+    the store can add to them atomically.  A pickle never looks like one.
+    """
+    shared = True
+
+    def __init__(self, client, ttl=60, prefix="posts:"):
+        super(SharedCache, self).__init__()
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @property
+    def per_process(self):
+        return getattr(self.client, "per_process", False)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        if value is None:
+            self.lookup(key, False)
+            return None
+        self.lookup(key, True)
+        if value.lstrip("-").isdigit():
+            return int(value)
+        return pickle.loads(value)
+
+    def set(self, key, value):
+        if isinstance(value, (int, long)) and not isinstance(value, bool):
+            value = str(value)
+        else:
+            value = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self.client.set(self.prefix + key, value, self.ttl)
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def incr(self, key, delta=1):
+        return self.client.incr(self.prefix + key, delta)
+
+    def clear(self):
+        self.client.clear()
+
+
+class LocalClient(object):
+    """
+    A stand-in for a shared store client which keeps everything in a
+    dictionary, for development and testing.  Despite the name of the
+    backend, nothing stored is seen by other processes.
+    """
+    per_process = True
+
+    def __init__(self):
+        self.items = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            expires, value = self.items.get(key, (None, None))
+            if expires is not None and expires < time.time():
+                del self.items[key]
+                return None
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.items[key] = (time.time() + ttl, value)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
+
+    def incr(self, key, delta=1):
+        with self.lock:
+            expires, value = self.items.get(key, (None, None))
+            if value is None or expires < time.time():
+                return None
+            value = int(value) + delta
+            self.items[key] = (expires, str(value))
+            return value
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+def make_cache(config):
+    """
+    Create the cache described by the app config
+
+    CACHE_BACKEND is "lru" (the default), "shared" or "none".  CACHE_TTL is
+    how many seconds values are kept for, CACHE_MAX_SIZE bounds the LRU
+    cache, and CACHE_CLIENT is the import path of a factory for the shared
+    store's client.
+    """
+    backend = config.get("CACHE_BACKEND", "lru")
+    ttl = config.get("CACHE_TTL", 60)
+    if backend == "lru":
+        return LRUCache(config.get("CACHE_MAX_SIZE", 1024), ttl)
+    if backend == "shared":
+        client = import_string(config.get("CACHE_CLIENT",
+                                          "posts.cache.LocalClient"))()
+        return SharedCache(client, ttl)
+    return NullCache()
+
+
+def post_key(id, written, mimetype):
+    """
+    The key a post serialized as mimetype is cached under, until it is next
+    written after the time written
+    """
+    return "{}{}:{}:{}".format(POST_PREFIX, id, written, mimetype)
+
+
+def written_key(id):
+    """ The key saying when a post was last written """
+    return "written:{}".format(id)
+
+
+def init_app(app):
+    """
+    Use the cache described by an app's config, for every app in the process
+    """
+    global _cache
+    _cache = make_cache(app.config)
+
+
+_cache = NullCache()
+cache = LocalProxy(lambda: _cache)
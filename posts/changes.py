@@ -0,0 +1,164 @@
+import time
+import datetime
+import threading
+
+from sqlalchemy import event
+
+import models
+from cache import cache
+from database import Session
+
+changes_table = models.PostChange.__table__
+
+# The type of a stream of Server-Sent Events
+EVENT_STREAM = "text/event-stream"
+# Bumped in a shared cache by every write which logs changes, so that
+# requests waiting for changes in any process notice them without querying
+# the database
+COUNTER_KEY = "changes:counter"
+# Changes are numbered as they are written, but become visible as their
+# transactions commit, which may be in a different order.  Changes after a
+# gap in the numbers are held back until the gap is filled, or until this
+# many seconds after the gap was first seen, by when whatever left it must
+# have committed or rolled back.
+GAP_SECONDS = 5
+# How long a gap is remembered for after it was first seen
+GAP_MEMORY_SECONDS = 3600
+
+# When this process first saw each gap in the numbers, by the first number
+# missing
+gaps = {}
+gaps_lock = threading.Lock()
+
+
+def record(session, op, post_ids):
+    """ Log a change to a list of posts in the same transaction """
+    if not post_ids:
+        return
+    now = datetime.datetime.utcnow()
+    session.execute(changes_table.insert(),
+                    [{"post_id": post_id, "op": op, "changed_at": now}
+                     for post_id in post_ids])
+    # How many posts each kind of change has been logged for, which counts
+    # keeps the cached total up to date with
+    logged = session.info.setdefault("changed", {})
+    logged[op] = logged.get(op, 0) + len(post_ids)
+
+
+def as_dictionary(row):
+    return {
+        "seq": row.seq,
+        "id": row.post_id,
+        "op": row.op,
+        "changed_at": row.changed_at.isoformat()
+    }
+
+
+def read(session, since, limit):
+    """ Return up to limit changes logged after the change numbered since """
+    rows = session.query(changes_table).filter(
+        changes_table.c.seq > since).order_by(changes_table.c.seq).limit(
+        limit).all()
+    expected = since + 1
+    for i, row in enumerate(rows):
+        if row.seq != expected and not gap_expired(expected):
+            rows = rows[:i]
+            break
+        expected = row.seq + 1
+    return [as_dictionary(row) for row in rows]
+
+
+def gap_expired(seq):
+    """
+    Check whether it is GAP_SECONDS since the change numbered seq was first
+    found to be missing, so that changes after it can be sent without it
+    """
+    now = time.time()
+    with gaps_lock:
+        # Forget gaps which every reader has long since moved past
+        for old in [old for old, seen in gaps.items()
+                    if seen < now - GAP_MEMORY_SECONDS and old != seq]:
+            del gaps[old]
+        return gaps.setdefault(seq, now) + GAP_SECONDS < now
+
+
+class Notifier(object):
+    """ Wakes up requests waiting for changes when this process logs one """
+    def __init__(self):
+        self.count = 0
+        self.condition = threading.Condition()
+
+    def notify(self):
+        with self.condition:
+            self.count += 1
+            self.condition.notify_all()
+
+    def wait(self, count, timeout):
+        """
+        Wait for up to timeout seconds for the count to move on from count,
+        and return the new count
+        """
+        with self.condition:
+            if self.count == count:
+                self.condition.wait(timeout)
+            return self.count
+
+
+notifier = Notifier()
+
+
+@event.listens_for(Session, "after_commit")
+def after_commit(session):
+    if session.info.pop("changed", False):
+        cache.incr(COUNTER_KEY)
+        notifier.notify()
+
+
+@event.listens_for(Session, "after_rollback")
+def after_rollback(session):
+    session.info.pop("changed", None)
+
+
+def counter():
+    """
+    The number of writes logged in the shared cache, or None if there is no
+    shared cache to tell us about writes in other processes
+    """
+    if not cache.shared:
+        return None
+    value = cache.get(COUNTER_KEY)
+    if value is None:
+        # Writes which came before this are found by the next read
+        cache.set(COUNTER_KEY, 0)
+        value = 0
+    return value
+
+
+def wait(session, since, limit, timeout, poll_interval):
+    """
+    Return the changes after since, waiting for up to timeout seconds for
+    there to be some.  Writes in this process end the wait straight away.
+    Writes in others are noticed within poll_interval seconds, from the
+    shared cache if there is one and otherwise by reading the log again.
+    """
+    deadline = time.time() + timeout
+    changes = read(session, since, limit)
+    while not changes and time.time() < deadline:
+        # Don't hold on to a connection while waiting
+        session.close()
+        count, seen = notifier.count, counter()
+        while time.time() < deadline:
+            if notifier.wait(count, min(poll_interval,
+                                        deadline - time.time())) != count:
+                break
+            if seen is None or counter() != seen:
+                break
+        changes = read(session, since, limit)
+    return changes
+
+
+def prune(session, days):
+    """ Forget changes logged more than days ago """
+    cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=days)
+    session.execute(changes_table.delete().where(
+        changes_table.c.changed_at < cutoff))
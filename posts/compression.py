@@ -0,0 +1,361 @@
+import json
+import zlib
+from io import BytesIO
+
+from flask import request, current_app
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import LimitedStream
+
+# brotli and zstd are only offered when their libraries are installed
+try:
+    import brotli
+except ImportError:
+    brotli = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Every encoding we might use, in order of preference
+ENCODINGS = ("br", "zstd", "gzip")
+# Compressing bodies of other types is a waste of time.  Event streams
+# aren't compressed either, as the compressor would hold events back.
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson",
+                          "application/msgpack", "text/plain")
+
+
+class GzipCompressor(object):
+    def __init__(self, level):
+        # 16 + MAX_WBITS writes a gzip header rather than a zlib one
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                           16 + zlib.MAX_WBITS)
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+class BrotliCompressor(object):
+    def __init__(self, level):
+        self.compressor = brotli.Compressor(quality=min(level, 11))
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+
+class ZstdCompressor(object):
+    def __init__(self, level):
+        self.compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data):
+        return self.compressor.compress(data)
+
+    def flush(self):
+        return self.compressor.flush()
+
+
+COMPRESSORS = {"gzip": GzipCompressor}
+if brotli is not None:
+    COMPRESSORS["br"] = BrotliCompressor
+if zstandard is not None:
+    COMPRESSORS["zstd"] = ZstdCompressor
+
+
+# How much of a compressed request body is read from the client at a time
+READ_SIZE = 64 * 1024
+
+
+class TooLarge(Exception):
+    """ A request body decompresses to more than the most we accept """
+
+
+class InvalidData(Exception):
+    """ A request body isn't valid data in its Content-Encoding """
+    def __init__(self, encoding):
+        super(InvalidData, self).__init__(encoding)
+        self.encoding = encoding
+
+
+class GzipReader(object):
+    def __init__(self, stream):
+        self.stream = stream
+        # 32 + MAX_WBITS accepts both gzip and zlib headers
+        self.decompressor = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        self.tail = b""
+
+    def read(self, size):
+        while True:
+            if not self.tail:
+                self.tail = self.stream.read(READ_SIZE)
+                if not self.tail:
+                    return self.decompressor.flush()
+            data = self.decompressor.decompress(self.tail, size)
+            self.tail = self.decompressor.unconsumed_tail
+            if data:
+                return data
+
+
+class BrotliReader(object):
+    def __init__(self, stream):
+        self.stream = stream
+        self.decompressor = brotli.Decompressor()
+
+    def read(self, size):
+        # Whatever is left of the input already given comes out first
+        data = self.decompressor.process(b"", output_buffer_limit=size)
+        while not data:
+            chunk = self.stream.read(READ_SIZE)
+            if not chunk:
+                if not self.decompressor.is_finished():
+                    raise ValueError("Truncated brotli data")
+                return b""
+            data = self.decompressor.process(chunk, output_buffer_limit=size)
+        return data
+
+
+class ZstdReader(object):
+    def __init__(self, stream):
+        self.reader = zstandard.ZstdDecompressor().stream_reader(
+            stream, read_size=READ_SIZE)
+
+    def read(self, size):
+        return self.reader.read(size)
+
+
+def limits_brotli_output():
+    """
+    Check whether the brotli library can stop decompressing part way, which
+    older versions can't
+    """
+    try:
+        brotli.Decompressor().process(b"", output_buffer_limit=1)
+    except TypeError:
+        return False
+    return True
+
+
+DECOMPRESSORS = {"gzip": GzipReader, "deflate": GzipReader}
+# A brotli library which can't limit its output would let a small body use
+# up all of our memory
+if brotli is not None and limits_brotli_output():
+    DECOMPRESSORS["br"] = BrotliReader
+if zstandard is not None:
+    DECOMPRESSORS["zstd"] = ZstdReader
+
+
+class DecompressedStream(object):
+    """
+    A request body which is decompressed as it is read, so that memory use
+    doesn't grow with its size.  Reading more than max_size bytes from it
+    raises TooLarge.
+    """
+    def __init__(self, stream, encoding, max_size):
+        self.reader = DECOMPRESSORS[encoding](stream)
+        self.encoding = encoding
+        self.max_size = max_size
+        self.size = 0
+        # Decompressed data which hasn't been read yet starts at position
+        self.buffer = b""
+        self.position = 0
+
+    def more(self):
+        """ Decompress the next piece of the body, or b"" at the end """
+        try:
+            # Never decompress much past max_size
+            data = self.reader.read(min(READ_SIZE,
+                                        self.max_size - self.size + 1))
+        except Exception:
+            raise InvalidData(self.encoding)
+        self.size += len(data)
+        if self.size > self.max_size:
+            raise TooLarge()
+        return data
+
+    def read(self, size=-1):
+        chunks = [self.buffer[self.position:]]
+        length = len(chunks[0])
+        while size < 0 or length < size:
+            data = self.more()
+            if not data:
+                break
+            chunks.append(data)
+            length += len(data)
+        data = b"".join(chunks)
+        if size < 0 or size >= len(data):
+            self.buffer, self.position = b"", 0
+            return data
+        self.buffer, self.position = data, size
+        return data[:size]
+
+    def readline(self, size=-1):
+        end = self.buffer.find(b"\n", self.position)
+        while end < 0 and (size < 0 or
+                           len(self.buffer) - self.position < size):
+            data = self.more()
+            if not data:
+                break
+            # Only look for the end of the line in what is new
+            start = len(self.buffer) - self.position
+            self.buffer = self.buffer[self.position:] + data
+            self.position = 0
+            end = self.buffer.find(b"\n", start)
+        end = len(self.buffer) if end < 0 else end + 1
+        if size >= 0:
+            end = min(end, self.position + size)
+        line = self.buffer[self.position:end]
+        self.position = end
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+
+def init_app(app):
+    """
+    Compress responses, and accept compressed request bodies.  Bodies are
+    decompressed as they are read, so memory use doesn't grow with their
+    size, but no more than COMPRESSION_MAX_REQUEST_SIZE bytes of one are
+    read; raise it for larger compressed imports.
+    """
+    app.after_request(compress_response)
+    app.register_error_handler(TooLarge, too_large)
+    app.register_error_handler(InvalidData, invalid_data)
+    app.wsgi_app = DecompressMiddleware(
+        app.wsgi_app, app.config.get("COMPRESSION_MAX_REQUEST_SIZE",
+                                     16 * 1024 * 1024))
+
+
+def compress_response(response):
+    """
+    Compress a response with the best encoding the client accepts
+
+    COMPRESSION_MIN_SIZE is the smallest body worth compressing, and
+    COMPRESSION_LEVEL how hard to try.  Streamed responses are compressed
+    as they are sent, whatever their size.
+    """
+    if response.status_code == 304:
+        return not_modified_etag(response)
+    if (response.status_code < 200 or response.status_code == 204 or
+            response.mimetype not in COMPRESSIBLE_MIMETYPES or
+            "Content-Encoding" in response.headers or
+            response.direct_passthrough):
+        return response
+    response.vary.add("Accept-Encoding")
+
+    config = current_app.config
+    encoding = best_encoding()
+    if encoding is None:
+        return response
+    compressor = COMPRESSORS[encoding](config.get("COMPRESSION_LEVEL", 6))
+
+    if response.is_streamed:
+        response.response = compress_stream(compressor, response.response)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < config.get("COMPRESSION_MIN_SIZE", 500):
+            return response
+        response.set_data(compressor.compress(data) + compressor.flush())
+
+    response.headers["Content-Encoding"] = encoding
+    # A compressed body is a different representation, so needs its own
+    # strong entity tag
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag("{}-{}".format(etag, encoding), weak)
+    return response
+
+
+def best_encoding():
+    """
+    The encoding to compress the response with, or None if compression is
+    off or the client accepts none we have
+    """
+    if not current_app.config.get("COMPRESSION_ENABLED", True):
+        return None
+    return request.accept_encodings.best_match(
+        [encoding for encoding in ENCODINGS if encoding in COMPRESSORS])
+
+
+def not_modified_etag(response):
+    """
+    Give a 304 the entity tag the full response would have been sent with,
+    suffixed by the encoding it would have been compressed with.  A client
+    whose copy is the plain body, which small bodies are sent as, is told
+    the plain tag it already has.
+    """
+    response.vary.add("Accept-Encoding")
+    etag, weak = response.get_etag()
+    encoding = best_encoding()
+    if etag and encoding and not request.if_none_match.contains_weak(etag):
+        response.set_etag("{}-{}".format(etag, encoding), weak)
+    return response
+
+
+def compress_stream(compressor, chunks):
+    """ Compress a response body as it is generated """
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class DecompressMiddleware(object):
+    """
+    Decompress request bodies sent with a Content-Encoding as the app reads
+    them, so that the app only ever sees the plain body.  Reading more than
+    max_size bytes of a body raises TooLarge.
+    """
+    def __init__(self, app, max_size):
+        self.app = app
+        self.max_size = max_size
+
+    def __call__(self, environ, start_response):
+        encoding = environ.get("HTTP_CONTENT_ENCODING", "").strip().lower()
+        if not encoding or encoding == "identity":
+            return self.app(environ, start_response)
+
+        if encoding not in DECOMPRESSORS:
+            message = "Unsupported content encoding {}".format(encoding)
+            return error(message, 415)(environ, start_response)
+
+        # Bodies sent in chunks have no length, and the server says when
+        # they end instead
+        stream = environ["wsgi.input"]
+        length = environ.get("CONTENT_LENGTH")
+        if length:
+            stream = LimitedStream(stream, int(length))
+        elif not environ.get("wsgi.input_terminated"):
+            stream = BytesIO()
+
+        environ["wsgi.input"] = DecompressedStream(stream, encoding,
+                                                   self.max_size)
+        # Nobody knows the decompressed length until it has all been read
+        environ["wsgi.input_terminated"] = True
+        environ.pop("CONTENT_LENGTH", None)
+        del environ["HTTP_CONTENT_ENCODING"]
+        return self.app(environ, start_response)
+
+
+def too_large(exception):
+    return error("Request body is too large once decompressed", 413)
+
+
+def invalid_data(exception):
+    message = "Request body is not valid {} data".format(exception.encoding)
+    return error(message, 400)
+
+
+def error(message, status):
+    data = json.dumps({"message": message})
+    return Response(data, status, mimetype="application/json")
@@ -0,0 +1,101 @@
+import json
+import hashlib
+
+from flask import request, Response
+
+import serializers
+from compression import ENCODINGS
+
+
+def with_suffix(etag, suffix):
+    return "{}-{}".format(etag, suffix) if suffix else etag
+
+
+def post_etag(id, version):
+    """ The entity tag for a version of a post in the type being sent """
+    return with_suffix("{}-{}".format(id, version),
+                       serializers.current().etag_suffix)
+
+
+def list_etag(*parts):
+    """ The entity tag for a list, built from a summary of its contents """
+    summary = json.dumps([request.query_string, serializers.current().mimetype]
+                         + [str(part) for part in parts])
+    return hashlib.md5(summary).hexdigest()
+
+
+def variants(etag):
+    """
+    The entity tags a client might have for a resource, which get a suffix
+    when the body is compressed
+    """
+    return [etag] + [with_suffix(etag, encoding) for encoding in ENCODINGS]
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Check whether the If-None-Match or If-Modified-Since headers say that
+    the client's copy of a resource is still current
+    """
+    if request.if_none_match:
+        return any(request.if_none_match.contains_weak(variant)
+                   for variant in variants(etag))
+    if request.if_modified_since and last_modified:
+        # HTTP dates only go down to the second
+        return last_modified.replace(microsecond=0) <= \
+            request.if_modified_since
+    return False
+
+
+def representations(id, version):
+    """
+    Every entity tag a version of a post might have been sent with, whichever
+    type and encoding the client fetched it as
+    """
+    etag = "{}-{}".format(id, version)
+    return [variant for serializer in serializers.SERIALIZERS.values()
+            for variant in variants(with_suffix(etag,
+                                                serializer.etag_suffix))]
+
+
+def precondition_failed(id, version):
+    """ Check whether the If-Match header rules out changing a post """
+    return bool(request.if_match) and not any(
+        request.if_match.contains(etag)
+        for etag in representations(id, version))
+
+
+def matching_versions(id):
+    """
+    The versions of a post the If-Match header allows changing, so that they
+    can be checked in the UPDATE itself, or None if any version will do
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    versions = set()
+    for etag in request.if_match.as_set():
+        parts = etag.split("-")
+        if len(parts) < 2 or parts[0] != str(id) or not parts[1].isdigit():
+            continue
+        if etag in representations(id, parts[1]):
+            versions.add(int(parts[1]))
+    return versions
+
+
+def add_validators(response, etag, last_modified=None):
+    """ Set the ETag and Last-Modified headers on a response """
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+    return response
+
+
+def not_modified_response(etag, last_modified=None):
+    """ A 304 Not Modified response, which has no body """
+    return add_validators(Response(status=304), etag, last_modified)
+
+
+def precondition_failed_response(id):
+    """ A 412 Precondition Failed response for a post which has changed """
+    message = "Post with id {} has been modified".format(id)
+    return serializers.response({"message": message}, 412)
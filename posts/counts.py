@@ -0,0 +1,98 @@
+import json
+import time
+import hashlib
+
+from sqlalchemy import event, func
+
+import models
+import database
+from cache import cache
+from database import Session
+
+# The number of posts, which writes keep up to date rather than forgetting
+TOTAL_KEY = "count:total"
+# Bumped by every write, so that filtered counts cached before it are never
+# read again
+GENERATION_KEY = "count:generation"
+# When the last write was, so that counts from a replica which may not have
+# caught up with it aren't kept
+CHANGED_KEY = "count:changed_at"
+# The generation the cached total was counted in, so that a write can tell
+# whether the total may have counted it already
+TOTAL_GENERATION_KEY = "count:total_generation"
+
+
+def generation():
+    """ The current generation of cached counts """
+    value = cache.get(GENERATION_KEY)
+    if value is None:
+        # Start from the clock so that an evicted generation isn't reused
+        value = int(time.time() * 1000000)
+        cache.set(GENERATION_KEY, value)
+    return value
+
+
+def count(posts, filters):
+    """
+    Count the posts a query matches, from the cache if we can.  filters is
+    what the query was narrowed down by, and becomes part of the cache key;
+    with no filters at all the total number of posts is used.
+    """
+    current = generation()
+    if any(filters):
+        key = "count:{}:{}".format(
+            current, hashlib.md5(json.dumps(filters)).hexdigest())
+    else:
+        key = TOTAL_KEY
+    value = cache.get(key)
+    if value is None:
+        # Sharded posts are counted on every shard at once
+        value = sum(rows[0][0] for rows in database.scatter(
+            posts.order_by(None).with_entities(func.count(models.Post.id))))
+        # Don't keep a count which a write may have overtaken while it ran
+        changed_at = cache.get(CHANGED_KEY) or 0
+        if (cache.get(GENERATION_KEY) == current and
+                changed_at + database.replica_lag() < time.time()):
+            if key == TOTAL_KEY:
+                cache.set(TOTAL_GENERATION_KEY, current)
+            cache.set(key, value)
+    return value
+
+
+def changed(written, created=0, deleted=0):
+    """
+    Bring the cached counts up to date after a write has committed.  written
+    is the generation the write moved on to before it committed.
+    """
+    cache.incr(GENERATION_KEY, 1)
+    if created != deleted:
+        cache.incr(TOTAL_KEY, created - deleted)
+        # A total counted since the write began committing may include it
+        # already, and adding to that would count it twice
+        counted = cache.get(TOTAL_GENERATION_KEY)
+        if written is None or counted is None or counted >= written:
+            cache.delete(TOTAL_KEY)
+    if database.get_replicas():
+        cache.set(CHANGED_KEY, time.time())
+
+
+@event.listens_for(Session, "before_commit")
+def before_commit(session):
+    # Counts taken while the write commits may or may not see it, so move
+    # the generation on first for them to notice, as well as afterwards
+    logged = session.info.get("changed")
+    if logged:
+        session.info["counts"] = (cache.incr(GENERATION_KEY, 1),
+                                  logged.get("create", 0),
+                                  logged.get("delete", 0))
+
+
+@event.listens_for(Session, "after_commit")
+def after_commit(session):
+    if "counts" in session.info:
+        changed(*session.info.pop("counts"))
+
+
+@event.listens_for(Session, "after_rollback")
+def after_rollback(session):
+    session.info.pop("counts", None)
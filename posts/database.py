@@ -1,10 +1,394 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+import time
+import zlib
+import heapq
+import random
+import itertools
+import threading
+from multiprocessing.pool import ThreadPool
+
+from flask import g, request, has_request_context
+from sqlalchemy import create_engine, event, exc, select
+from sqlalchemy import Table, Column, Integer, String
+from sqlalchemy.orm import sessionmaker, scoped_session, Session as BaseSession
+from sqlalchemy.sql.expression import UpdateBase
 from sqlalchemy.ext.declarative import declarative_base
+from werkzeug.local import LocalProxy
+
+
+def engine_options(config, uri):
+    """
+    Build the keyword arguments for create_engine from the app config
+
+    DATABASE_POOL_SIZE, DATABASE_MAX_OVERFLOW and DATABASE_POOL_TIMEOUT size
+    the connection pool, and DATABASE_POOL_RECYCLE is the number of seconds
+    after which a connection is replaced, or -1 to keep them forever.
+    """
+    options = {"pool_recycle": config.get("DATABASE_POOL_RECYCLE", -1)}
+    # SQLite uses a pool which can't be sized
+    if not uri.startswith("sqlite"):
+        options["pool_size"] = config.get("DATABASE_POOL_SIZE", 5)
+        options["max_overflow"] = config.get("DATABASE_MAX_OVERFLOW", 10)
+        options["pool_timeout"] = config.get("DATABASE_POOL_TIMEOUT", 30)
+    return options
+
+
+def ping_connection(connection, branch):
+    """
+    Check that a connection is still alive before it is used, so that one
+    dropped by the server is replaced rather than failing a request
+    """
+    # Sub-connections share their parent's DBAPI connection
+    if branch:
+        return
+    should_close_with_result = connection.should_close_with_result
+    connection.should_close_with_result = False
+    try:
+        connection.scalar(select([1]))
+    except exc.DBAPIError as error:
+        # The pool has been invalidated, so the retry gets a new connection
+        if error.connection_invalidated:
+            connection.scalar(select([1]))
+        else:
+            raise
+    finally:
+        connection.should_close_with_result = should_close_with_result
+
+
+# The settings of the app using the database, and the engines built from
+# them the first time they are needed
+config = {}
+_engine = None
+_replicas = None
+_shards = None
+_pool = None
+_ids = None
+_lock = threading.Lock()
+
+
+def init_app(app):
+    """
+    Use the database described by an app's config.  The engines are shared
+    by the whole process, so every app uses the last database set up.
+    """
+    configure(app.config)
+    app.after_request(remember_write)
+    app.teardown_appcontext(shutdown_session)
+
+
+def configure(settings):
+    """ Switch to new database settings, throwing away any existing engine """
+    global config
+    dispose()
+    config = dict(settings)
+
+
+def make_engine(uri):
+    engine = create_engine(uri, **engine_options(config, uri))
+    if config.get("DATABASE_POOL_PRE_PING", True):
+        event.listen(engine, "engine_connect", ping_connection)
+    return engine
+
+
+def get_engine():
+    """ Return the engine, connecting to the database the first time """
+    global _engine
+    if _engine is None:
+        with _lock:
+            if _engine is None:
+                _engine = make_engine(config["DATABASE_URI"])
+    return _engine
+
+
+def get_replicas():
+    """
+    Return the engines for the read replicas listed in
+    DATABASE_REPLICA_URIS, which is empty if there aren't any
+    """
+    global _replicas
+    if _replicas is None:
+        with _lock:
+            if _replicas is None:
+                _replicas = [make_engine(uri) for uri in
+                             config.get("DATABASE_REPLICA_URIS", [])]
+    return _replicas
+
+
+def get_shards():
+    """
+    Return the engines for the shards listed in DATABASE_SHARD_URIS, which
+    is empty if posts aren't sharded
+    """
+    global _shards
+    if _shards is None:
+        with _lock:
+            if _shards is None:
+                _shards = [make_engine(uri) for uri in
+                           config.get("DATABASE_SHARD_URIS", [])]
+    return _shards
+
+
+def sharded():
+    """ Check whether posts are spread across shards, without connecting """
+    return bool(config.get("DATABASE_SHARD_URIS"))
+
+
+def dispose():
+    """
+    Close the engines' connections, and forget them.  The scatter threads
+    and the block of ids being handed out go too, as a forked process has
+    to start its own.
+    """
+    global _engine, _replicas, _shards, _pool, _ids
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+    for replica in (_replicas or []) + (_shards or []):
+        replica.dispose()
+    _replicas = None
+    _shards = None
+    if _pool is not None:
+        _pool.close()
+        _pool = None
+    _ids = None
+
+
+# Nothing connects to the database until the engine is first used
+engine = LocalProxy(get_engine)
+
+
+class RoutingSession(BaseSession):
+    """
+    A session which finds the engine when it first needs it
+
+    Writes always go to the primary.  Reads go to a replica once use_replica
+    has been called, the same one for the rest of the session.  A session
+    given a shard by use_shard sends everything there instead.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        shard = self.info.get("shard")
+        if self._flushing or isinstance(clause, UpdateBase):
+            self.info["wrote"] = True
+            return shard or get_engine()
+        if shard is not None:
+            return shard
+        replica = self.info.get("replica")
+        if replica is not None:
+            return replica
+        return get_engine()
+
+
+def use_replica():
+    """
+    Send the reads of the current session to a read replica, unless the
+    client wrote something so recently that it might not have reached the
+    replicas yet
+    """
+    replicas = get_replicas()
+    if not replicas or recently_wrote():
+        return
+    session().info["replica"] = random.choice(replicas)
+
+
+def replica_lag():
+    """
+    How far behind the primary the reads of the current session may be, in
+    seconds.  Replicas are taken to catch up within DATABASE_STICKY_SECONDS.
+    """
+    if session().info.get("replica") is None:
+        return 0
+    return config.get("DATABASE_STICKY_SECONDS", 5)
+
+
+def sticky_cookie():
+    return config.get("DATABASE_STICKY_COOKIE", "posts_primary_until")
+
+
+def recently_wrote():
+    """ Check whether the client is still reading its own writes """
+    try:
+        until = float(request.cookies.get(sticky_cookie(), 0))
+    except ValueError:
+        return False
+    return until > time.time()
+
+
+def remember_write(response):
+    """
+    After a write send the client's reads to the primary for the next
+    DATABASE_STICKY_SECONDS, so that it sees its own writes however far
+    behind the replicas are
+    """
+    if getattr(g, "wrote", False) and get_replicas():
+        seconds = config.get("DATABASE_STICKY_SECONDS", 5)
+        response.set_cookie(sticky_cookie(), str(time.time() + seconds),
+                            max_age=seconds)
+    return response
+
+
+def shard_for(id):
+    """
+    The engine for the shard holding the post with an id.  Hashing the id
+    spreads the posts evenly even though ids are handed out in blocks.
+    """
+    shards = get_shards()
+    return shards[(zlib.crc32(str(id)) & 0xffffffff) % len(shards)]
+
+
+def use_shard(id):
+    """
+    Send every query of the current session to the shard holding the post
+    with an id, if posts are sharded
+    """
+    if sharded():
+        session().info["shard"] = shard_for(id)
+
+
+def new_id():
+    """
+    Return a new post id which is unique across every shard, or None to let
+    the database number the post if posts aren't sharded
+    """
+    global _ids
+    if not sharded():
+        return None
+    if _ids is None:
+        with _lock:
+            if _ids is None:
+                _ids = IdAllocator(config.get("DATABASE_ID_BLOCK_SIZE", 100))
+    return _ids.allocate()
+
+
+def get_pool():
+    """
+    The threads which query the shards, DATABASE_SCATTER_THREADS of them or
+    by default four for each shard
+    """
+    global _pool
+    if _pool is None:
+        threads = config.get("DATABASE_SCATTER_THREADS",
+                             4 * len(get_shards()))
+        with _lock:
+            if _pool is None:
+                _pool = ThreadPool(threads)
+    return _pool
+
+
+def run_on(shard, query):
+    """ Run a query on one shard in a session of its own """
+    shard_session = Session(info={"shard": shard})
+    try:
+        return query.with_session(shard_session).all()
+    finally:
+        shard_session.close()
+
+
+def scatter(query):
+    """
+    Run a query on every shard at once, and return the rows from each in
+    shard order.  If posts aren't sharded the query just runs, giving a
+    single list.
+    """
+    if not sharded():
+        return [query.all()]
+    shards = get_shards()
+    return get_pool().map(lambda shard: run_on(shard, query), shards)
+
+
+def gather(query, key, limit=None):
+    """
+    Run a query ordered by key on every shard at once, and merge the rows
+    into key order.  Each shard only sends the first limit rows, and only
+    the first limit of all of them are kept.
+    """
+    if limit is not None:
+        query = query.limit(limit)
+    results = scatter(query)
+    if len(results) == 1:
+        return results[0]
+    merged = heapq.merge(*[[(key(row), row) for row in rows]
+                           for rows in results])
+    return [row for _, row in itertools.islice(merged, limit)]
+
+
+def merged(query, key):
+    """
+    Iterate over the rows of a query ordered by key on every shard, merging
+    them into key order as they are read.  Nothing is fetched from a shard
+    until the merge needs its next row, so this suits streaming.
+    """
+    if not sharded():
+        for row in query:
+            yield row
+        return
+    sessions = [Session(info={"shard": shard}) for shard in get_shards()]
+    try:
+        rows = [((key(row), row) for row in query.with_session(shard_session))
+                for shard_session in sessions]
+        for _, row in heapq.merge(*rows):
+            yield row
+    finally:
+        for shard_session in sessions:
+            shard_session.close()
+
+
+class IdAllocator(object):
+    """
+    Hands out post ids which are unique across every shard.  Each process
+    reserves a block of ids at a time in the main database, so only the
+    first post of each block waits for it.
+    """
+    def __init__(self, block_size):
+        self.block_size = block_size
+        self.next = self.end = 0
+        self.lock = threading.Lock()
+
+    def allocate(self):
+        with self.lock:
+            if self.next == self.end:
+                self.next = self.reserve()
+                self.end = self.next + self.block_size
+            id = self.next
+            self.next += 1
+            return id
+
+    def reserve(self):
+        """ Take the next block of ids, returning the first of them """
+        size = self.block_size
+        where = id_blocks.c.name == "posts"
+        while True:
+            # The update locks the row until the block is read back
+            with get_engine().begin() as connection:
+                updated = connection.execute(id_blocks.update().where(
+                    where).values(next_id=id_blocks.c.next_id + size))
+                if updated.rowcount:
+                    return connection.scalar(select(
+                        [id_blocks.c.next_id]).where(where)) - size
+            try:
+                get_engine().execute(id_blocks.insert(), name="posts",
+                                     next_id=1 + size)
+                return 1
+            except exc.IntegrityError:
+                # Another process took the first block, so take the next
+                continue
 
-from posts import app
 
-engine = create_engine(app.config["DATABASE_URI"])
 Base = declarative_base()
-Session = sessionmaker(bind=engine)
-session = Session()
+
+# The next post id to hand out when posts are sharded
+id_blocks = Table("id_blocks", Base.metadata,
+                  Column("name", String(64), primary_key=True),
+                  Column("next_id", Integer, nullable=False))
+Session = sessionmaker(class_=RoutingSession)
+# Each thread gets its own session, which is thrown away at the end of the
+# request so that a failed transaction can't leak into the next one
+session = scoped_session(Session)
+
+
+@event.listens_for(Session, "after_commit")
+def after_commit(session):
+    if session.info.pop("wrote", False) and has_request_context():
+        g.wrote = True
+
+
+def shutdown_session(exception=None):
+    session.remove()
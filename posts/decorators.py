@@ -1,36 +1,77 @@
 import json
 from functools import wraps
 
-from flask import request, Response
+from flask import g, request, Response
 
-def accept(mimetype):
+import serializers
+import database
+
+def accept(*mimetypes):
     def decorator(func):
         """
         Decorator which returns a 406 Not Acceptable if the client won't accept
-        a certain mimetype
+        any of the given mimetypes, and otherwise picks the one to respond with
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if mimetype in request.accept_mimetypes:
+            mimetype = serializers.best_match(mimetypes)
+            if mimetype is not None:
+                g.response_mimetype = mimetype
                 return func(*args, **kwargs)
-            message = "Request must accept {} data".format(mimetype)
+            message = "Request must accept {} data".format(mimetypes[0])
             data = json.dumps({"message": message})
             return Response(data, 406, mimetype="application/json")
         return wrapper
     return decorator
 
-def require(mimetype):
+def require(*mimetypes):
     def decorator(func):
         """
         Decorator which returns a 415 Unsupported Media Type if the client sends
-        something other than a certain mimetype
+        something other than one of the given mimetypes
         """
         @wraps(func)
         def wrapper(*args, **kwargs):
-            if (request.mimetype ==  mimetype):
+            if request.mimetype in mimetypes:
                 return func(*args, **kwargs)
-            message = "Request must contain {} data".format(mimetype)
+            message = "Request must contain {} data".format(mimetypes[0])
             data = json.dumps({"message": message})
             return Response(data, 415, mimetype="application/json")
         return wrapper
-    return decorator
\ No newline at end of file
+    return decorator
+
+def read_replica(func):
+    """
+    Decorator for endpoints which only read, sending their queries to a read
+    replica if there are any
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        database.use_replica()
+        return func(*args, **kwargs)
+    return wrapper
+
+def shard_by_id(func):
+    """
+    Decorator for endpoints about a single post, sending their queries to
+    the shard which holds it if posts are sharded
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        database.use_shard(kwargs["id"])
+        return func(*args, **kwargs)
+    return wrapper
+
+def unsharded(func):
+    """
+    Decorator for endpoints which need every post in one database, which
+    return a 501 Not Implemented if posts are sharded
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        if not database.sharded():
+            return func(*args, **kwargs)
+        message = "Not available while posts are sharded"
+        data = json.dumps({"message": message})
+        return Response(data, 501, mimetype="application/json")
+    return wrapper
@@ -0,0 +1,182 @@
+import os
+import time
+import threading
+
+from flask import g
+from sqlalchemy import select
+
+import bulk
+import search
+from database import Session
+from metrics import phase
+
+posts_table = bulk.posts_table
+
+
+class Write(object):
+    """
+    A create or edit of a post waiting for its group to commit.  Once done
+    is set, status is the HTTP status for the write and post is the new row
+    of bulk.UPDATED_COLUMNS if it succeeded.
+    """
+    def __init__(self, op, values, post_id=None, versions=None):
+        self.op = op
+        self.values = values
+        self.post_id = post_id
+        self.versions = versions
+        self.status = None
+        self.post = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(object):
+    """
+    Commits writes queued by many requests together in one transaction, as
+    soon as max_items are waiting or max_wait seconds after the first one
+    arrived, whichever comes first
+    """
+    def __init__(self, max_items, max_wait, logger):
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self.logger = logger
+        self.queue = []
+        self.condition = threading.Condition()
+        self.pid = None
+        # The number of transactions committed, and the writes in them
+        self.groups = 0
+        self.writes = 0
+
+    def submit(self, write):
+        """ Queue a write and wait until its group has been committed """
+        with self.condition:
+            if self.pid != os.getpid():
+                # Threads don't survive a fork, so each worker process
+                # starts its own
+                self.pid = os.getpid()
+                self.queue = []
+                thread = threading.Thread(target=self.run,
+                                          name="group-commit")
+                thread.daemon = True
+                thread.start()
+            self.queue.append(write)
+            self.condition.notify()
+        write.done.wait()
+        return write
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                # Give the group until max_wait after its first write to
+                # fill up
+                deadline = time.time() + self.max_wait
+                while (len(self.queue) < self.max_items and
+                       time.time() < deadline):
+                    self.condition.wait(deadline - time.time())
+                group = self.queue[:self.max_items]
+                self.queue = self.queue[self.max_items:]
+            self.commit(group)
+
+    def commit(self, group):
+        """
+        Commit a group of writes together.  If that fails they are retried
+        one at a time, so that only the writes to blame fail.
+        """
+        try:
+            session = Session()
+            try:
+                apply_writes(session, group)
+                session.commit()
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+            self.groups += 1
+            self.writes += len(group)
+        except Exception:
+            if len(group) > 1:
+                for write in group:
+                    self.commit([write])
+            else:
+                self.logger.exception("Could not commit a %s of a post",
+                                      group[0].op)
+                group[0].status, group[0].post = 500, None
+        finally:
+            for write in group:
+                write.done.set()
+
+
+def apply_writes(session, group):
+    """ Make a group of writes in a session, recording how each went """
+    creates = [write for write in group if write.op == "create"]
+    ids = bulk.insert_posts(session, [write.values for write in creates])
+    if ids:
+        rows = session.execute(select(bulk.UPDATED_COLUMNS).where(
+            posts_table.c.id.in_(ids)))
+        created = dict((row.id, row) for row in rows)
+        for write, post_id in zip(creates, ids):
+            write.status, write.post = 201, created[post_id]
+
+    # Several edits to the same post are made in order, but it only needs
+    # indexing once
+    edited = {}
+    for write in group:
+        if write.op != "update":
+            continue
+        post = bulk.update_post(session, write.post_id, write.values,
+                                write.versions)
+        if post is not None:
+            write.status, write.post = 200, post
+            edited[post.id] = post
+            continue
+        # Find out whether the post is missing or has moved on
+        exists = session.execute(select([posts_table.c.id]).where(
+            posts_table.c.id == write.post_id)).first()
+        write.status, write.post = (412 if exists else 404), None
+    search.index_posts(session, [{"id": post.id, "title": post.title,
+                                  "body": post.body}
+                                 for post in edited.values()])
+
+
+def init_app(app):
+    """
+    Commit creates and edits of single posts in groups if
+    GROUP_COMMIT_ENABLED is set.  GROUP_COMMIT_MAX_ITEMS is the most writes
+    in a group, and GROUP_COMMIT_MAX_WAIT_MS the longest a write waits for
+    others to join it.
+    """
+    global _committer
+    _committer = None
+    if app.config.get("GROUP_COMMIT_ENABLED", False):
+        if app.config.get("DATABASE_SHARD_URIS"):
+            # A group is committed in a single transaction, which can't
+            # span shards
+            app.logger.warning("Group commit is off while posts are sharded")
+            return
+        _committer = GroupCommitter(
+            app.config.get("GROUP_COMMIT_MAX_ITEMS", 100),
+            app.config.get("GROUP_COMMIT_MAX_WAIT_MS", 5) / 1000.0,
+            app.logger)
+
+
+def enabled():
+    return _committer is not None
+
+
+def submit(op, values, post_id=None, versions=None):
+    """
+    Create ("create") or edit ("update") a post as part of the next group
+    commit, and return the Write once it has been committed
+    """
+    with phase("commit"):
+        write = _committer.submit(Write(op, values, post_id, versions))
+    if write.status in (200, 201):
+        # The commit happened in another thread, so tell the database layer
+        # this request wrote something; see database.remember_write
+        g.wrote = True
+    return write
+
+
+_committer = None
@@ -0,0 +1,206 @@
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+from StringIO import StringIO
+
+from flask import g, request, Response, current_app, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from database import Session
+from cache import cache
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# Upper bounds of the queries per request histogram buckets
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram(object):
+    """ A Prometheus style histogram, with cumulative buckets """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        """ Yield the lines of the exposition format for this histogram """
+        with self.lock:
+            for bound, count in zip(self.buckets, self.counts):
+                yield "{}_bucket{} {}".format(
+                    name, format_labels(labels, le=bound), count)
+            yield "{}_bucket{} {}".format(
+                name, format_labels(labels, le="+Inf"), self.count)
+            yield "{}_sum{} {}".format(name, format_labels(labels), self.sum)
+            yield "{}_count{} {}".format(name, format_labels(labels),
+                                         self.count)
+
+
+class HistogramFamily(object):
+    """ A set of histograms with the same name but different labels """
+    def __init__(self, name, help, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(self.buckets)
+        histogram.observe(value)
+
+    def lines(self):
+        yield "# HELP {} {}".format(self.name, self.help)
+        yield "# TYPE {} histogram".format(self.name)
+        for key, histogram in sorted(self.histograms.items()):
+            for line in histogram.samples(self.name, dict(key)):
+                yield line
+
+
+def format_labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(key, value)
+                          for key, value in sorted(labels.items())) + "}"
+
+
+request_duration = HistogramFamily(
+    "posts_request_duration_seconds",
+    "Time taken to handle a request", LATENCY_BUCKETS)
+phase_duration = HistogramFamily(
+    "posts_request_phase_duration_seconds",
+    "Time spent in each phase of handling a request", LATENCY_BUCKETS)
+request_queries = HistogramFamily(
+    "posts_request_queries",
+    "Number of SQL queries run to handle a request", QUERY_BUCKETS)
+
+
+@contextmanager
+def phase(name):
+    """ Time a phase of the current request, such as validation """
+    start = time.time()
+    try:
+        yield
+    finally:
+        if has_app_context() and hasattr(g, "phases"):
+            g.phases[name] = g.phases.get(name, 0) + time.time() - start
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if has_app_context():
+        g.query_start = time.time()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    if has_app_context() and hasattr(g, "phases"):
+        g.queries += 1
+        g.phases["query"] = (g.phases.get("query", 0) +
+                             time.time() - g.query_start)
+
+
+@event.listens_for(Session, "before_commit")
+def before_commit(session):
+    if has_app_context():
+        g.commit_start = time.time()
+
+
+@event.listens_for(Session, "after_commit")
+def after_commit(session):
+    if has_app_context() and hasattr(g, "commit_start"):
+        g.phases["commit"] = (g.phases.get("commit", 0) +
+                              time.time() - g.commit_start)
+
+
+def init_app(app):
+    """ Instrument an app, and add its /metrics endpoint """
+    app.before_request(start_timing)
+    app.after_request(record_timing)
+    app.add_url_rule("/metrics", "metrics", metrics, methods=["GET"])
+
+
+def profiling_requested():
+    return (current_app.config.get("PROFILING_ENABLED", current_app.debug)
+            and request.headers.get("X-Profile") == "1")
+
+
+def start_timing():
+    g.request_start = time.time()
+    g.phases = {}
+    g.queries = 0
+    if profiling_requested():
+        g.profiler = cProfile.Profile()
+        g.profiler.enable()
+
+
+def record_timing(response):
+    if not hasattr(g, "request_start"):
+        return response
+    elapsed = time.time() - g.request_start
+    endpoint = request.endpoint or "unmatched"
+    request_duration.observe(elapsed, endpoint=endpoint,
+                             method=request.method,
+                             status=response.status_code)
+    request_queries.observe(g.queries, endpoint=endpoint)
+    for name, seconds in g.phases.items():
+        phase_duration.observe(seconds, endpoint=endpoint, phase=name)
+
+    # Let the client see where the time went
+    response.headers["X-Query-Count"] = str(g.queries)
+    timings = ["{};dur={:.3f}".format(name, 1000 * seconds)
+               for name, seconds in sorted(g.phases.items())]
+    timings.append("total;dur={:.3f}".format(1000 * elapsed))
+    response.headers["Server-Timing"] = ", ".join(timings)
+
+    # Lots of queries for one request usually means an N+1 pattern
+    if g.queries > current_app.config.get("METRICS_QUERY_WARNING", 20):
+        current_app.logger.warning("%s ran %d queries", endpoint, g.queries)
+
+    # Swap the body for the profile if the client asked for one
+    profiler = getattr(g, "profiler", None)
+    if profiler is not None:
+        profiler.disable()
+        output = StringIO()
+        stats = pstats.Stats(profiler, stream=output)
+        stats.sort_stats("cumulative").print_stats(30)
+        response.set_data(output.getvalue())
+        response.mimetype = "text/plain"
+        response.headers["X-Profile"] = "1"
+    return response
+
+
+def metrics():
+    """ Prometheus metrics for this process """
+    lines = []
+    for family in [request_duration, phase_duration, request_queries]:
+        lines.extend(family.lines())
+    for name, value in sorted(cache.stats().items()):
+        metric = "posts_cache_{}".format(name)
+        if name != "size":
+            metric += "_total"
+        lines.append("# TYPE {} {}".format(
+            metric, "gauge" if name == "size" else "counter"))
+        lines.append("{} {}".format(metric, value))
+    return Response("\n".join(lines) + "\n", 200,
+                    content_type="text/plain; version=0.0.4; charset=utf-8")
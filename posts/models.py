@@ -1,4 +1,7 @@
-from sqlalchemy import Column, Integer, String, Sequence
+import datetime
+
+from sqlalchemy import Column, Integer, String, Sequence, ForeignKey, Index
+from sqlalchemy import DateTime, func
 
 from database import Base
 
@@ -8,6 +11,15 @@ class Post(Base):
     id = Column(Integer, primary_key=True)
     title = Column(String(128))
     body = Column(String(1024))
+    # Bumped on every change, and checked on every ORM update so that two
+    # concurrent edits can't silently overwrite each other.  Databases made
+    # before these columns were added need `python manage.py migrate`.
+    version = Column(Integer, nullable=False, default=1)
+    updated_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow,
+                        onupdate=datetime.datetime.utcnow)
+
+    __mapper_args__ = {"version_id_col": version}
 
     def as_dictionary(self):
         post = {
@@ -15,4 +27,75 @@ class Post(Base):
             "title": self.title,
             "body": self.body
         }
-        return post
\ No newline at end of file
+        return post
+
+# The columns to select to serialize posts without building ORM objects
+POST_COLUMNS = (Post.id, Post.title, Post.body)
+
+# The fields of a post clients can ask for, in the order they are selected
+FIELDS = ("id", "title", "body")
+
+def projected_columns(fields, body_preview=None):
+    """
+    The columns to select for some of the fields of a post, so that the
+    others are never read.  The body can be cut down to its first
+    body_preview characters by the database.
+    """
+    columns = []
+    for field in fields:
+        column = getattr(Post, field)
+        if field == "body" and body_preview is not None:
+            column = func.substr(column, 1, body_preview).label("body")
+        columns.append(column)
+    return tuple(columns)
+
+def row_dictionary(row, fields=None):
+    """
+    The same dictionary as Post.as_dictionary for a row of POST_COLUMNS, or
+    of the projected_columns for a list of fields
+    """
+    if fields is not None:
+        return dict(zip(fields, row))
+    post = {
+        "id": row[0],
+        "title": row[1],
+        "body": row[2]
+    }
+    return post
+
+class PostTerm(Base):
+    """ An entry in the search index saying that a term appears in a post """
+    __tablename__ = "post_terms"
+
+    term = Column(String(64), primary_key=True)
+    post_id = Column(Integer, ForeignKey("posts.id"), primary_key=True)
+    weight = Column(Integer, nullable=False)
+
+    # The primary key indexes lookups by term; this one makes removing all
+    # of the terms for a post cheap
+    __table_args__ = (Index("ix_post_terms_post_id", "post_id"),)
+
+class PostChange(Base):
+    """
+    An entry in the log of changes to posts, which clients follow rather
+    than fetching every post again to see what is different
+    """
+    __tablename__ = "post_changes"
+    # Clients remember the last number they saw, so numbers are never used
+    # again once pruned, which SQLite otherwise does
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    seq = Column(Integer, primary_key=True)
+    # Not a foreign key, as deleted posts stay in the log
+    post_id = Column(Integer, nullable=False)
+    # One of "create", "update" or "delete"
+    op = Column(String(16), nullable=False)
+    changed_at = Column(DateTime, nullable=False,
+                        default=datetime.datetime.utcnow)
+
+class ImportCheckpoint(Base):
+    """ How many lines of an NDJSON import have been committed """
+    __tablename__ = "import_checkpoints"
+
+    id = Column(String(64), primary_key=True)
+    lines = Column(Integer, nullable=False)
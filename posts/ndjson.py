@@ -0,0 +1,33 @@
+import json
+
+from serializers import fastjson
+
+MIMETYPE = "application/x-ndjson"
+
+
+def stream(items):
+    """ Generate NDJSON, one item per line """
+    for item in items:
+        yield fastjson.dumps(item) + "\n"
+
+
+def chunks(lines, size, skip=0):
+    """
+    Parse NDJSON lines into lists of at most size (line number, item) pairs,
+    without reading more than one chunk ahead.  Line numbers start from 1;
+    the first skip lines and any blank lines are passed over.  Raises
+    ValueError naming the first line which isn't valid JSON.
+    """
+    chunk = []
+    for number, line in enumerate(lines, 1):
+        if number <= skip or not line.strip():
+            continue
+        try:
+            chunk.append((number, json.loads(line)))
+        except ValueError:
+            raise ValueError("Line {} is not valid JSON".format(number))
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
@@ -0,0 +1,103 @@
+import re
+from collections import Counter
+
+from sqlalchemy import func, and_, or_
+
+import models
+
+# Words are runs of letters and digits, compared case insensitively
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+# Longer words are truncated so that they fit in the term column
+MAX_TERM_LENGTH = 64
+# A word in the title counts for more than the same word in the body
+TITLE_WEIGHT = 3
+BODY_WEIGHT = 1
+
+terms_table = models.PostTerm.__table__
+
+
+def tokenize(text):
+    """ Split a piece of text into a list of lowercase terms """
+    return [word[:MAX_TERM_LENGTH]
+            for word in WORD_RE.findall(text.lower())]
+
+
+def term_weights(title, body):
+    """ Count how strongly each term is associated with a post """
+    weights = Counter()
+    for term in tokenize(title):
+        weights[term] += TITLE_WEIGHT
+    for term in tokenize(body):
+        weights[term] += BODY_WEIGHT
+    return weights
+
+
+def index_post(session, post_id, title, body):
+    """ Add a post to the search index, replacing any existing entries """
+    index_posts(session, [{"id": post_id, "title": title, "body": body}])
+
+
+def index_posts(session, posts):
+    """
+    Add a list of post dictionaries to the search index in one statement,
+    replacing any existing entries
+    """
+    unindex_posts(session, [post["id"] for post in posts])
+    rows = [{"term": term, "post_id": post["id"], "weight": weight}
+            for post in posts
+            for term, weight in term_weights(post["title"],
+                                             post["body"]).items()]
+    if rows:
+        session.execute(terms_table.insert(), rows)
+
+
+def unindex_post(session, post_id):
+    """ Remove a post from the search index """
+    unindex_posts(session, [post_id])
+
+
+def unindex_posts(session, post_ids):
+    """ Remove a list of posts from the search index """
+    if post_ids:
+        session.execute(terms_table.delete().where(
+            terms_table.c.post_id.in_(post_ids)))
+
+
+def rebuild(session, batch_size=1000):
+    """ Rebuild the search index from scratch for every post """
+    session.execute(terms_table.delete())
+    posts = session.query(models.Post.id, models.Post.title, models.Post.body)
+    rows = []
+    for post_id, title, body in posts.yield_per(batch_size):
+        rows.extend({"term": term, "post_id": post_id, "weight": weight}
+                    for term, weight in term_weights(title, body).items())
+        if len(rows) >= batch_size:
+            session.execute(terms_table.insert(), rows)
+            rows = []
+    if rows:
+        session.execute(terms_table.insert(), rows)
+
+
+def ranked(session, query):
+    """
+    Return a subquery of (post_id, rank) for the posts which contain every
+    term in the query, or None if the query contains no terms
+    """
+    terms = set(tokenize(query))
+    if not terms:
+        return None
+    rank = func.sum(models.PostTerm.weight).label("rank")
+    return (session.query(models.PostTerm.post_id.label("post_id"), rank)
+            .filter(models.PostTerm.term.in_(terms))
+            .group_by(models.PostTerm.post_id)
+            .having(func.count(models.PostTerm.term) == len(terms))
+            .subquery())
+
+
+def after_cursor(ranking, rank, post_id):
+    """
+    Filter for the ranked results which come after (rank, post_id), with
+    results ordered by descending rank and then by id
+    """
+    return or_(ranking.c.rank < rank,
+               and_(ranking.c.rank == rank, ranking.c.post_id > post_id))
@@ -0,0 +1,125 @@
+import json
+from collections import OrderedDict
+
+from flask import g, request, Response, has_app_context
+from werkzeug.exceptions import BadRequest
+
+from metrics import phase
+
+# simplejson produces exactly the same output as the standard library, so
+# use its C speedups when it is installed
+try:
+    import simplejson as fastjson
+except ImportError:
+    fastjson = json
+
+# MessagePack is only offered when it is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONSerializer(object):
+    mimetype = "application/json"
+    # Added to entity tags to tell representations apart
+    etag_suffix = ""
+
+    def dumps(self, data):
+        return fastjson.dumps(data)
+
+    def loads(self, data):
+        return json.loads(data)
+
+    def stream(self, items):
+        """ Generate a JSON array one item at a time """
+        yield "["
+        for i, item in enumerate(items):
+            if i:
+                yield ", "
+            yield self.dumps(item)
+        yield "]"
+
+
+class MsgpackSerializer(object):
+    mimetype = "application/msgpack"
+    etag_suffix = "msgpack"
+
+    def dumps(self, data):
+        return msgpack.packb(data)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False)
+
+    def stream(self, items):
+        """
+        Generate a sequence of MessagePack objects, one per item.  An array
+        has to start with its length, so can't be streamed;
+        msgpack.Unpacker reads a sequence back one object at a time.
+        """
+        packer = msgpack.Packer()
+        for item in items:
+            yield packer.pack(item)
+
+
+# Every serializer available, the default first
+SERIALIZERS = OrderedDict([(JSONSerializer.mimetype, JSONSerializer())])
+if msgpack is not None:
+    SERIALIZERS[MsgpackSerializer.mimetype] = MsgpackSerializer()
+MIMETYPES = tuple(SERIALIZERS)
+
+
+def best_match(mimetypes):
+    """
+    Pick the mimetype the client most wants from a list, or None if it
+    accepts none of them.  Ties go to the earlier mimetype.
+    """
+    best, best_quality = None, 0
+    for mimetype in mimetypes:
+        quality = request.accept_mimetypes[mimetype]
+        if quality > best_quality:
+            best, best_quality = mimetype, quality
+    return best
+
+
+def current():
+    """
+    The serializer for the response to the current request.  Endpoints which
+    send a type without a serializer, such as NDJSON, use JSON for anything
+    else they send.
+    """
+    mimetype = None
+    if has_app_context():
+        mimetype = getattr(g, "response_mimetype", None)
+    return SERIALIZERS.get(mimetype, SERIALIZERS[JSONSerializer.mimetype])
+
+
+def dumps(data):
+    """ Serialize data in the representation the client asked for """
+    with phase("serialize"):
+        return current().dumps(data)
+
+
+def stream(items):
+    """ Serialize a list of items as they are generated """
+    return current().stream(items)
+
+
+def load_request():
+    """ Deserialize the body of the current request """
+    serializer = SERIALIZERS.get(request.mimetype)
+    if serializer is None:
+        raise BadRequest("Unsupported request type")
+    # Reading a compressed body can fail in ways of its own; see compression
+    data = request.get_data()
+    try:
+        return serializer.loads(data)
+    except Exception:
+        message = "Request body is not valid {} data".format(request.mimetype)
+        raise BadRequest(message)
+
+
+def response(data, status, headers=None):
+    """ A response containing data serialized for the client """
+    return Response(dumps(data), status, headers=headers,
+                    mimetype=current().mimetype)
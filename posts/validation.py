@@ -0,0 +1,31 @@
+from jsonschema import ValidationError
+from jsonschema.validators import validator_for
+
+from metrics import phase
+
+# Validators which have already been built, keyed by the id of their schema.
+# The schema is kept alongside so that its id can't be reused.
+compiled = {}
+
+
+def compile_schema(schema):
+    """
+    Check a schema and build a validator for it once, so that later calls
+    to validate can reuse it.  Schemas mustn't be changed once compiled.
+    """
+    entry = compiled.get(id(schema))
+    if entry is None:
+        cls = validator_for(schema)
+        cls.check_schema(schema)
+        entry = compiled[id(schema)] = (schema, cls(schema))
+    return entry[1]
+
+
+def validate(data, schema):
+    """
+    Validate data against a schema, raising the same ValidationError as
+    jsonschema.validate but without checking the schema and building a new
+    validator every time
+    """
+    with phase("validate"):
+        compile_schema(schema).validate(data)
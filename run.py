@@ -1,10 +1,273 @@
+"""
+Serve the API from a pool of worker processes which share one listening
+socket, so that every core is used
+
+    PORT=8080 WORKERS=4 MAX_REQUESTS=10000 python run.py
+
+The app is imported once before the workers are forked, and each worker
+drops any database connections it inherited.  Settings come from the
+environment:
+
+    PORT            the port to listen on, 8080 by default
+    WORKERS         the number of worker processes, by default one per CPU
+                    if the cache is shared and otherwise just one, which
+                    the default config's in-process cache means (see below)
+    THREADED        0 to handle one request at a time in each worker,
+                    rather than each request in its own thread (the
+                    default), which clients waiting on the change feed need
+    MAX_REQUESTS    replace a worker after this many requests, or 0 (the
+                    default) to keep it forever
+    SERVER          "development" to run the Flask development server
+                    instead, which handles every request in one process
+
+Each worker has its own copy of anything the app keeps in memory.  With
+more than one worker the cache of posts and counts has to be one every
+process sees, so the app's config must set CACHE_BACKEND to "none", or to
+"shared" with a CACHE_CLIENT for a real shared store; otherwise run.py
+refuses to start more than one.  The metrics are kept by each worker too,
+so /metrics only reports on the requests handled by whichever worker
+answered it.  Scrape each worker, or run a single worker where the totals
+matter.
+
+Send the master SIGHUP to load new code and settings without dropping a
+request: it starts again in place, starts new workers on the same socket,
+and lets the old ones finish what they are doing before they exit.
+SIGTERM or SIGINT stop everything the same gracefully.
+"""
 import os
-from posts import app
+import sys
+import time
+import errno
+import random
+import signal
+import socket
+import threading
+import multiprocessing
+
+from werkzeug.serving import (BaseWSGIServer, ThreadedWSGIServer,
+                              WSGIRequestHandler)
+
+from posts import app, database
+from posts.cache import cache
+
+# How long workers get to finish their requests when stopping
+GRACEFUL_TIMEOUT = 30
+
 
 def run():
     port = int(os.environ.get('PORT', 8080))
-    app.run(host='0.0.0.0', port=port)
+    if os.environ.get('SERVER') == 'development':
+        app.run(host='0.0.0.0', port=port, threaded=True)
+        return
+    # Each worker would cache its own copy of a post, and go on serving it
+    # after another worker had changed it
+    default_workers = 1 if cache.per_process else multiprocessing.cpu_count()
+    workers = int(os.environ.get('WORKERS', default_workers))
+    if workers > 1 and cache.per_process:
+        sys.exit('WORKERS={} needs a cache every worker sees.  Set '
+                 'CACHE_BACKEND to "none", or to "shared" with a '
+                 'CACHE_CLIENT.'.format(workers))
+    threaded = os.environ.get('THREADED', '1') != '0'
+    max_requests = int(os.environ.get('MAX_REQUESTS', 0))
+    Master(listen(port), workers, threaded, max_requests).run()
+
+
+def listen(port):
+    """
+    Return the listening socket, which a master reloading itself hands on
+    to its new self in LISTEN_FD
+    """
+    fd = os.environ.pop('LISTEN_FD', None)
+    if fd is not None:
+        listener = socket.fromfd(int(fd), socket.AF_INET, socket.SOCK_STREAM)
+        os.close(int(fd))
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(('0.0.0.0', port))
+        listener.listen(socket.SOMAXCONN)
+    # Workers which lose the race to accept a connection go back to waiting
+    # rather than blocking in accept
+    listener.setblocking(False)
+    return listener
+
+
+class Master(object):
+    """ Keeps the right number of workers running, and replaces them """
+    def __init__(self, listener, workers, threaded, max_requests):
+        self.listener = listener
+        self.count = workers
+        self.threaded = threaded
+        self.max_requests = max_requests
+        self.workers = set()
+        # Workers started by the master before it reloaded itself
+        self.retiring = set(int(pid) for pid in os.environ.pop(
+            'RETIRING_WORKERS', '').split(',') if pid)
+        self.state = 'running'
+
+    def run(self):
+        signal.signal(signal.SIGHUP, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+        signal.signal(signal.SIGINT, self.handle_signal)
+        # The master never queries the database, but make sure there is no
+        # pool for the workers to inherit
+        database.dispose()
+        app.logger.info('Serving on %s with %d workers',
+                        self.listener.getsockname(), self.count)
+
+        while self.state == 'running':
+            while len(self.workers) < self.count:
+                self.workers.add(self.spawn())
+            # The new workers are ready, so the old ones can finish up
+            self.kill(self.retiring)
+            if self.reap() == 0:
+                time.sleep(0.1)
+
+        if self.state == 'reloading':
+            self.reload()
+        self.stop()
+
+    def handle_signal(self, signum, frame):
+        self.state = 'reloading' if signum == signal.SIGHUP else 'stopping'
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 1
+        try:
+            Worker(self.listener, self.threaded, self.max_requests).run()
+            status = 0
+        except Exception:
+            app.logger.exception('Worker %d failed', os.getpid())
+        finally:
+            os._exit(status)
+
+    def kill(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError as error:
+                if error.errno != errno.ESRCH:
+                    raise
+
+    def reap(self):
+        """ Forget workers which have exited, returning how many there were """
+        reaped = 0
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    return reaped
+                if error.errno == errno.EINTR:
+                    continue
+                raise
+            if pid == 0:
+                return reaped
+            reaped += 1
+            self.retiring.discard(pid)
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if status and self.state == 'running':
+                    app.logger.warning('Worker %d exited with status %d',
+                                       pid, status)
+                    # Don't spin if workers can't start
+                    time.sleep(1)
+
+    def reload(self):
+        """
+        Start again in place, with the same process id and listening socket,
+        leaving the current workers for the new master to retire
+        """
+        app.logger.info('Reloading')
+        os.environ['LISTEN_FD'] = str(self.listener.fileno())
+        os.environ['RETIRING_WORKERS'] = ','.join(
+            str(pid) for pid in self.workers | self.retiring)
+        os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def stop(self):
+        """ Let every worker finish its requests, then exit """
+        workers = self.workers | self.retiring
+        self.kill(workers)
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        while (self.workers or self.retiring) and time.time() < deadline:
+            if self.reap() == 0:
+                time.sleep(0.1)
+        self.kill(self.workers | self.retiring, signal.SIGKILL)
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    """ Doesn't write a line to stderr for every request; errors still are """
+    def log_request(self, code='-', size='-'):
+        pass
+
+
+class Worker(object):
+    """ Serves requests from the shared socket until told to stop """
+    def __init__(self, listener, threaded, max_requests):
+        self.listener = listener
+        self.threaded = threaded
+        self.max_requests = max_requests
+        self.running = True
+
+    def run(self):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, self.stop)
+        # Connections made before the fork belong to the master, and the
+        # workers mustn't all make the same random choices
+        database.dispose()
+        random.seed()
+
+        server = self.make_server()
+        # Check whether to stop at least once a second
+        server.timeout = 1
+        handled = 0
+        while self.running:
+            if self.max_requests and handled >= self.max_requests:
+                break
+            server.handle_request()
+            handled = server.handled
+        # Let requests being handled by other threads finish.  The app's own
+        # threads, such as the group committer and the shards' scatter pool,
+        # are daemons which never finish, so they aren't waited for.
+        deadline = time.time() + GRACEFUL_TIMEOUT
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread() and not thread.daemon:
+                thread.join(max(0, deadline - time.time()))
+        database.dispose()
+
+    def stop(self, signum, frame):
+        self.running = False
+
+    def make_server(self):
+        listener = self.listener
+        base = ThreadedWSGIServer if self.threaded else BaseWSGIServer
+
+        class Server(base):
+            # Count the requests accepted rather than every wake up
+            handled = 0
+            # Stopping waits for the threads handling requests by finding
+            # the threads which aren't daemons
+            daemon_threads = False
+
+            def server_bind(self):
+                # Serve from the master's socket rather than binding a new one
+                self.socket.close()
+                self.socket = listener
+                self.server_address = listener.getsockname()
+
+            def server_activate(self):
+                pass
+
+            def verify_request(self, request, client_address):
+                Server.handled += 1
+                return True
+
+        return Server('0.0.0.0', listener.getsockname()[1], app,
+                      QuietRequestHandler)
+
 
 if __name__ == '__main__':
     run()
-
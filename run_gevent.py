@@ -0,0 +1,44 @@
+"""
+Serve the API from a single process using gevent, so that requests waiting
+on the database don't tie up a worker each.  The routes and responses are
+exactly the same as with run.py.
+
+Needs gevent, and psycogreen to make psycopg2 cooperative:
+
+    pip install gevent psycogreen
+"""
+try:
+    from gevent import monkey
+except ImportError:
+    raise SystemExit("run_gevent.py needs gevent: pip install gevent")
+# Patch the standard library before anything else imports it, so that
+# sockets, threading.local and friends all yield to other greenlets
+monkey.patch_all()
+
+try:
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError:
+    patch_psycopg = None
+
+import os
+
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+
+from posts import app
+
+def run():
+    port = int(os.environ.get('PORT', 8080))
+    # The most requests to have in flight at once
+    concurrency = int(os.environ.get('CONCURRENCY', 1000))
+    if patch_psycopg is None and app.config["DATABASE_URI"].startswith(
+            "postgresql"):
+        app.logger.warning("psycogreen isn't installed, so every query "
+                           "will block the whole process")
+    server = WSGIServer(('0.0.0.0', port), app, spawn=Pool(concurrency),
+                        log=None)
+    server.serve_forever()
+
+if __name__ == '__main__':
+    run()
@@ -1,14 +1,18 @@
 import unittest
 import os
 import json
+import time
+import datetime
+import threading
 from urlparse import urlparse
 
 # Configure our app to use the testing database
 os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
 
 from posts import app
-from posts import models
-from posts.database import Base, engine, session
+from posts import models, changes, api, counts
+from posts.database import Base, Session, engine, session
+from posts.cache import cache, post_key, written_key
 
 
 class TestAPI(unittest.TestCase):
@@ -223,6 +227,170 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(post["title"], "Post with bells and whistles")
         self.assertEqual(post["body"], "Both bells and whistles")
 
+    def createPosts(self, *posts):
+        """ Create posts through the API so that they get indexed """
+        for title, body in posts:
+            self.client.post("/api/posts",
+                             data=json.dumps({"title": title, "body": body}),
+                             content_type="application/json",
+                             headers=[("Accept", "application/json")],
+                             )
+
+    def testSearchPosts(self):
+        """ Searching posts ranks title matches above body matches """
+        self.createPosts(("Post with bells", "No whistles"),
+                         ("Post with whistles", "No bells"),
+                         ("Just a post", "Nothing to see here"))
+
+        response = self.client.get("/api/posts?q=Whistles",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with whistles", "Post with bells"])
+
+        # Every term has to match
+        response = self.client.get("/api/posts?q=post+bells",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with bells", "Post with whistles"])
+
+    def testSearchPostsPaginated(self):
+        """ Paging through search results """
+        self.createPosts(("Bells", "Bells"),
+                         ("Bells", "Whistles"),
+                         ("Whistles", "Bells"))
+
+        response = self.client.get("/api/posts?q=bells&limit=2",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        posts = json.loads(response.data)
+        self.assertEqual([post["id"] for post in posts], [1, 2])
+
+        link = response.headers.get("Link")
+        url = urlparse(link[1:link.index(">")])
+        response = self.client.get("{}?{}".format(url.path, url.query),
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        posts = json.loads(response.data)
+        self.assertEqual([post["id"] for post in posts], [3])
+
+    def testSearchAfterEditAndDelete(self):
+        """ The search index follows edits and deletions """
+        self.createPosts(("Post with bells", "Just a test"),
+                         ("Another post", "Just a test"))
+
+        self.client.put("/api/posts/1",
+                        data=json.dumps({"title": "Post with whistles",
+                                         "body": "Just a test"}),
+                        content_type="application/json",
+                        headers=[("Accept", "application/json")],
+                        )
+        self.client.delete("/api/posts/2",
+                           headers=[("Accept", "application/json")],
+                           )
+
+        response = self.client.get("/api/posts?q=bells",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), [])
+
+        response = self.client.get("/api/posts?q=test",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        posts = json.loads(response.data)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Post with whistles"])
+
+    def testBatch(self):
+        """ Creating, editing and deleting posts in one batch """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+        data = {
+            "create": [{"title": "Example Post C", "body": "Another test"}],
+            "update": [{"id": 1, "title": "New Titular", "body": "Edited"},
+                       {"id": 5, "title": "Missing", "body": "Missing"}],
+            "delete": [2, 6]
+        }
+        response = self.client.post("/api/posts/batch",
+                                    data=json.dumps(data),
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json")],
+                                    )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+
+        data = json.loads(response.data)
+        self.assertEqual(data["create"][0]["status"], 201)
+        self.assertEqual(data["create"][0]["id"], 3)
+        self.assertEqual(urlparse(data["create"][0]["location"]).path,
+                         "/api/posts/3")
+        self.assertEqual([item["status"] for item in data["update"]],
+                         [200, 404])
+        self.assertEqual(data["update"][1]["message"],
+                         "Could not find post with id 5")
+        self.assertEqual([item["status"] for item in data["delete"]],
+                         [200, 404])
+
+        posts = session.query(models.Post).order_by(models.Post.id).all()
+        self.assertEqual([(post.id, post.title) for post in posts],
+                         [(1, "New Titular"), (3, "Example Post C")])
+
+        # The batch keeps the search index up to date
+        response = self.client.get("/api/posts?q=edited",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        posts = json.loads(response.data)
+        self.assertEqual([post["id"] for post in posts], [1])
+
+    def testInvalidBatch(self):
+        """ One invalid item rejects the whole batch """
+        data = {
+            "create": [{"title": "Example Post", "body": "Just a test"},
+                       {"title": "Example Post", "body": 32}]
+        }
+        response = self.client.post("/api/posts/batch",
+                                    data=json.dumps(data),
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json")],
+                                    )
+
+        self.assertEqual(response.status_code, 422)
+
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "32 is not of type 'string'")
+        self.assertEqual(data["path"], "create/1/body")
+        self.assertEqual(session.query(models.Post).count(), 0)
+
+    def testBatchItemsNotObjects(self):
+        """ Creates and updates which aren't objects are rejected """
+        for kind in ["create", "update"]:
+            response = self.client.post("/api/posts/batch",
+                                        data=json.dumps({kind: [5]}),
+                                        content_type="application/json",
+                                        headers=[("Accept",
+                                                  "application/json")],
+                                        )
+
+            self.assertEqual(response.status_code, 422)
+
+            data = json.loads(response.data)
+            self.assertEqual(data["message"], "5 is not of type 'object'")
+            self.assertEqual(data["path"], "{}/0".format(kind))
+
     def testGetPosts(self):
         """ Getting posts from a populated database """
         # Create a couple of sample posts
@@ -251,6 +419,442 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(postB["title"], "Example Post B")
         self.assertEqual(postB["body"], "Still a test")
 
+    def testGetPostsPaginated(self):
+        """ Paging through posts with limit and after """
+        posts = [models.Post(title="Post {}".format(i), body="Paged")
+                 for i in range(5)]
+        session.add_all(posts)
+        session.commit()
+
+        response = self.client.get("/api/posts?limit=2",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([post["title"] for post in data],
+                         ["Post 0", "Post 1"])
+
+        # Follow the Link header to the next page
+        link = response.headers.get("Link")
+        self.assertTrue(link.endswith('; rel="next"'))
+        url = urlparse(link[1:link.index(">")])
+        response = self.client.get("{}?{}".format(url.path, url.query),
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        data = json.loads(response.data)
+        self.assertEqual([post["title"] for post in data],
+                         ["Post 2", "Post 3"])
+
+        # The last page has no next link
+        response = self.client.get("/api/posts?limit=2&after={}".format(
+                                       data[-1]["id"]),
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        data = json.loads(response.data)
+        self.assertEqual([post["title"] for post in data], ["Post 4"])
+        self.assertEqual(response.headers.get("Link"), None)
+
+    def testGetPostsFields(self):
+        """ Getting only some of the fields of posts """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+        response = self.client.get("/api/posts?fields=title",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data),
+                         [{"id": 1, "title": "Example Post A"},
+                          {"id": 2, "title": "Example Post B"}])
+
+        response = self.client.get("/api/posts?body_preview=5&stream=1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual([post["body"] for post in json.loads(response.data)],
+                         ["Just ", "Still"])
+
+        response = self.client.get("/api/posts?fields=title,author",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Unknown field author")
+
+    def testGetPostFields(self):
+        """ Getting only some of the fields of a post """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        response = self.client.get("/api/posts/1?fields=body&body_preview=4",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"id": 1, "body": "Just"})
+        etag = response.headers.get("ETag")
+        self.assertEqual(etag, '"1-1-id.body.4"')
+
+        response = self.client.get("/api/posts/1?fields=body&body_preview=4",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 304)
+
+        # The whole post isn't affected by the projection
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["body"], "Just a test")
+
+        response = self.client.get("/api/posts/2?fields=title",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 404)
+
+    def testCountPosts(self):
+        """ Counting posts, which is kept in the cache between writes """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+        response = self.client.get("/api/posts/count",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data), {"count": 2})
+
+        # Creating a post brings the cached count up to date without
+        # counting the table again
+        self.client.post("/api/posts",
+                         data=json.dumps({"title": "Example Post C",
+                                          "body": "A third test"}),
+                         content_type="application/json",
+                         headers=[("Accept", "application/json")],
+                         )
+        response = self.client.get("/api/posts/count",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 3})
+        self.assertEqual(response.headers.get("X-Query-Count"), "0")
+
+        response = self.client.get("/api/posts/count?body_like=Still",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 1})
+
+        # Filtered counts are forgotten after any write
+        self.client.delete("/api/posts/2",
+                           headers=[("Accept", "application/json")],
+                           )
+        response = self.client.get("/api/posts/count?body_like=Still",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 0})
+        response = self.client.get("/api/posts/count",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 2})
+
+        response = self.client.get("/api/posts/count?q=nothing",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 0})
+
+    def testCountDuringCommit(self):
+        """ A total counted while a post commits doesn't count it twice """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        # The post is counted after it has committed, but before the write
+        # has brought the cached total up to date
+        changed = counts.changed
+
+        def count_then_change(*args, **kwargs):
+            other = Session()
+            counts.count(other.query(models.Post), (None, None, None))
+            other.close()
+            changed(*args, **kwargs)
+        counts.changed = count_then_change
+        try:
+            self.client.post("/api/posts",
+                             data=json.dumps({"title": "Example Post B",
+                                              "body": "Another test"}),
+                             content_type="application/json",
+                             headers=[("Accept", "application/json")],
+                             )
+        finally:
+            counts.changed = changed
+
+        response = self.client.get("/api/posts/count",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 2})
+
+    def testGetPostsTotalCount(self):
+        """ Every page of posts says how many posts there are in all """
+        for i in range(3):
+            session.add(models.Post(title="Example Post {}".format(i),
+                                    body="Just a test"))
+        session.commit()
+
+        response = self.client.get("/api/posts?limit=1&after=1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(len(json.loads(response.data)), 1)
+        self.assertEqual(response.headers.get("X-Total-Count"), "3")
+
+        response = self.client.get("/api/posts?title_like=Post%201&limit=1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.headers.get("X-Total-Count"), "1")
+
+    def testExportPosts(self):
+        """ Exporting every post as NDJSON """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+        response = self.client.get("/api/posts/export",
+                                   headers=[("Accept", "application/x-ndjson")],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        lines = response.data.splitlines()
+        self.assertEqual([json.loads(line)["title"] for line in lines],
+                         ["Example Post A", "Example Post B"])
+
+        # An export can carry on from the last post received
+        response = self.client.get("/api/posts/export?after=1",
+                                   headers=[("Accept", "application/x-ndjson")],
+                                   )
+        self.assertEqual([json.loads(line)["id"]
+                          for line in response.data.splitlines()], [2])
+
+    def testImportPosts(self):
+        """ Importing posts from NDJSON, a chunk at a time """
+        data = "\n".join(json.dumps({"title": "Post {}".format(i),
+                                     "body": "Imported zebra"})
+                         for i in range(5)) + "\n"
+        response = self.client.post("/api/posts/import?chunk_size=2",
+                                    data=data,
+                                    content_type="application/x-ndjson",
+                                    headers=[("Accept", "application/json")],
+                                    )
+
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data["imported"], 5)
+        self.assertIn("rows_per_second", data)
+        titles = [title for title, in session.query(models.Post.title)
+                  .order_by(models.Post.id)]
+        self.assertEqual(titles, ["Post {}".format(i) for i in range(5)])
+
+        # Imported posts are searchable
+        response = self.client.get("/api/posts/count?q=zebra",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data), {"count": 5})
+
+    def testImportPostsResume(self):
+        """ A failed import carries on from its last committed chunk """
+        posts = [json.dumps({"title": "Post {}".format(i), "body": "A test"})
+                 for i in range(4)]
+        posts[2] = json.dumps({"title": "Post 2", "body": 32})
+        response = self.client.post("/api/posts/import?chunk_size=2"
+                                    "&import_id=abc",
+                                    data="\n".join(posts),
+                                    content_type="application/x-ndjson",
+                                    headers=[("Accept", "application/json")],
+                                    )
+
+        self.assertEqual(response.status_code, 422)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"],
+                         "Line 3: 32 is not of type 'string'")
+        self.assertEqual(data["imported"], 2)
+        self.assertEqual(data["checkpoint"], 2)
+
+        # Sending the fixed stream again only imports what is left
+        posts[2] = json.dumps({"title": "Post 2", "body": "A test"})
+        response = self.client.post("/api/posts/import?chunk_size=2"
+                                    "&import_id=abc",
+                                    data="\n".join(posts),
+                                    content_type="application/x-ndjson",
+                                    headers=[("Accept", "application/json")],
+                                    )
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data["imported"], 2)
+        self.assertEqual(data["checkpoint"], 4)
+        titles = [title for title, in session.query(models.Post.title)
+                  .order_by(models.Post.id)]
+        self.assertEqual(titles, ["Post {}".format(i) for i in range(4)])
+
+    def testChanges(self):
+        """ Following the log of changes to posts """
+        headers = [("Accept", "application/json")]
+        self.client.post("/api/posts",
+                         data=json.dumps({"title": "Example Post A",
+                                          "body": "Just a test"}),
+                         content_type="application/json", headers=headers)
+        self.client.patch("/api/posts/1",
+                          data=json.dumps({"title": "New Titular"}),
+                          content_type="application/json", headers=headers)
+        self.client.delete("/api/posts/1", headers=headers)
+
+        response = self.client.get("/api/posts/changes", headers=headers)
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([(change["seq"], change["id"], change["op"])
+                          for change in data["changes"]],
+                         [(1, 1, "create"), (2, 1, "update"),
+                          (3, 1, "delete")])
+        self.assertEqual(data["last"], 3)
+
+        response = self.client.get("/api/posts/changes?since=2",
+                                   headers=headers)
+        data = json.loads(response.data)
+        self.assertEqual([change["op"] for change in data["changes"]],
+                         ["delete"])
+
+        # Nothing new means nothing sent, and the same place to carry on from
+        response = self.client.get("/api/posts/changes?since=3",
+                                   headers=headers)
+        self.assertEqual(json.loads(response.data),
+                         {"changes": [], "last": 3})
+
+        response = self.client.get("/api/posts/changes?since=-1",
+                                   headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    def testChangesHeldBackAfterGap(self):
+        """ Changes after a missing one wait for it, however old they are """
+        logged = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+        table = models.PostChange.__table__
+
+        def log(seq):
+            session.execute(table.insert(), {"seq": seq, "post_id": seq,
+                                             "op": "create",
+                                             "changed_at": logged})
+            session.commit()
+
+        log(1)
+        log(3)
+        self.assertEqual([change["seq"] for change in
+                          changes.read(session, 0, 10)], [1])
+        # The transaction which logged the missing change commits
+        log(2)
+        self.assertEqual([change["seq"] for change in
+                          changes.read(session, 0, 10)], [1, 2, 3])
+
+        # A change which never turns up is given up on in the end
+        log(5)
+        self.assertEqual(changes.read(session, 3, 10), [])
+        gap_seconds = changes.GAP_SECONDS
+        changes.GAP_SECONDS = -1
+        try:
+            self.assertEqual([change["seq"] for change in
+                              changes.read(session, 3, 10)], [5])
+        finally:
+            changes.GAP_SECONDS = gap_seconds
+            changes.gaps.clear()
+
+    def testChangesNumberedAfterPrune(self):
+        """ Pruning the log doesn't let change numbers be used again """
+        table = models.PostChange.__table__
+        for post_id in (1, 2):
+            changes.record(session, "create", [post_id])
+            session.commit()
+        changes.prune(session, -1)
+        session.commit()
+
+        changes.record(session, "create", [3])
+        session.commit()
+        self.assertEqual(session.execute(table.select()).first().seq, 3)
+
+    def testChangesLongPoll(self):
+        """ Waiting for changes returns as soon as a post is created """
+        def create():
+            time.sleep(0.2)
+            app.test_client().post("/api/posts",
+                                   data=json.dumps({"title": "Example Post",
+                                                    "body": "Just a test"}),
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")])
+        thread = threading.Thread(target=create)
+        thread.start()
+
+        start = time.time()
+        response = self.client.get("/api/posts/changes?wait=10",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        thread.join()
+        self.assertTrue(time.time() - start < 5)
+        data = json.loads(response.data)
+        self.assertEqual([change["op"] for change in data["changes"]],
+                         ["create"])
+
+    def testChangesEventStream(self):
+        """ Changes are sent as Server-Sent Events """
+        self.client.post("/api/posts",
+                         data=json.dumps({"title": "Example Post",
+                                          "body": "Just a test"}),
+                         content_type="application/json",
+                         headers=[("Accept", "application/json")])
+
+        app.config["CHANGES_STREAM_SECONDS"] = 0.5
+        try:
+            response = self.client.get(
+                "/api/posts/changes",
+                headers=[("Accept", "text/event-stream")])
+            data = response.data
+        finally:
+            del app.config["CHANGES_STREAM_SECONDS"]
+
+        self.assertEqual(response.mimetype, "text/event-stream")
+        event = data.split("\n\n")[0].split("\n")
+        self.assertEqual(event[:2], ["id: 1", "event: change"])
+        self.assertEqual(json.loads(event[2][len("data: "):])["op"],
+                         "create")
+
+    def testGetPostsInvalidLimit(self):
+        """ Asking for a page with a nonsense limit """
+        response = self.client.get("/api/posts?limit=-1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "limit must be a positive integer")
+
+    def testGetPostsStreamed(self):
+        """ Streaming posts gives the same JSON as the plain list """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+        plain = self.client.get("/api/posts",
+                                headers=[("Accept", "application/json")],
+                                )
+        streamed = self.client.get("/api/posts?stream=1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        self.assertEqual(streamed.status_code, 200)
+        self.assertEqual(streamed.mimetype, "application/json")
+        self.assertEqual(streamed.data, plain.data)
+
     def testGetEmptyPosts(self):
         """ Getting posts from an empty database """
         # Go to the page and get the response from the server, store it here
@@ -285,6 +889,285 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(post["title"], "Example Post B")
         self.assertEqual(post["body"], "Still a test")
 
+    def testGetPostCached(self):
+        """ A cached post is served until it is edited """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data)["title"], "Example Post A")
+
+        # Changing the database behind the API's back isn't noticed
+        session.query(models.Post).update({"title": "Sneaky"})
+        session.commit()
+        hits = cache.hits
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data)["title"], "Example Post A")
+        self.assertEqual(cache.hits, hits + 1)
+
+        # But editing through the API invalidates the cache
+        self.client.put("/api/posts/1",
+                        data=json.dumps({"title": "New Titular",
+                                         "body": "Tits"}),
+                        content_type="application/json",
+                        headers=[("Accept", "application/json")],
+                        )
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data)["title"], "New Titular")
+
+    def testGetPostStaleFillIgnored(self):
+        """ A post read before an edit but cached after it is never served """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        # A request finds the post isn't cached and reads it
+        written, _ = api.last_written(1)
+        data = json.dumps(postA.as_dictionary())
+
+        # Meanwhile another request edits the post
+        self.client.put("/api/posts/1",
+                        data=json.dumps({"title": "New Titular",
+                                         "body": "Tits"}),
+                        content_type="application/json",
+                        headers=[("Accept", "application/json")],
+                        )
+
+        # Then the first request caches what it read
+        cache.set(post_key(1, written, "application/json"),
+                  (data, '"1-1"', None))
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data)["title"], "New Titular")
+
+    def testGetPostNotModified(self):
+        """ A client with the current version of a post gets a 304 """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        etag = response.headers.get("ETag")
+        self.assertEqual(etag, '"1-1"')
+        last_modified = response.headers.get("Last-Modified")
+        self.assertTrue(last_modified)
+
+        # Both with and without the post in the cache
+        for i in range(2):
+            cache.clear()
+            response = self.client.get("/api/posts/1",
+                                       headers=[("Accept", "application/json"),
+                                                ("If-None-Match", etag)],
+                                       )
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(response.data, "")
+
+        response = self.client.get(
+            "/api/posts/1",
+            headers=[("Accept", "application/json"),
+                     ("If-Modified-Since", last_modified)],
+        )
+        self.assertEqual(response.status_code, 304)
+
+        # Editing the post changes its ETag
+        self.client.put("/api/posts/1",
+                        data=json.dumps({"title": "New Titular",
+                                         "body": "Tits"}),
+                        content_type="application/json",
+                        headers=[("Accept", "application/json")],
+                        )
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("ETag"), '"1-2"')
+
+    def testUpdatePostIfMatch(self):
+        """ Editing a post which someone else has changed fails with a 412 """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        data = json.dumps({"title": "New Titular", "body": "Tits"})
+        response = self.client.put("/api/posts/1",
+                                   data=data,
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-Match", '"1-1"')],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("ETag"), '"1-2"')
+
+        response = self.client.put("/api/posts/1",
+                                   data=data,
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-Match", '"1-1"')],
+                                   )
+        self.assertEqual(response.status_code, 412)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Post with id 1 has been modified")
+
+        response = self.client.delete("/api/posts/1",
+                                      headers=[("Accept", "application/json"),
+                                               ("If-Match", '"1-1"')],
+                                      )
+        self.assertEqual(response.status_code, 412)
+        self.assertEqual(session.query(models.Post).count(), 1)
+
+    def testUpdateNonExistentPost(self):
+        """ Editing a post which doesn't exist """
+        data = json.dumps({"title": "New Titular", "body": "Tits"})
+        response = self.client.put("/api/posts/1",
+                                   data=data,
+                                   content_type="application/json",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        self.assertEqual(response.status_code, 404)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Could not find post with id 1")
+
+    def testPatchPost(self):
+        """ Editing only the title of a post """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        response = self.client.patch("/api/posts/1",
+                                     data=json.dumps({"title": "Zebra"}),
+                                     content_type="application/json",
+                                     headers=[("Accept", "application/json"),
+                                              ("If-Match", '"1-1"')],
+                                     )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(urlparse(response.headers.get("Location")).path,
+                         "/api/posts/1")
+        self.assertEqual(response.headers.get("ETag"), '"1-2"')
+        data = json.loads(response.data)
+        self.assertEqual(data, {"id": 1, "title": "Zebra",
+                                "body": "Just a test"})
+
+        session.expire_all()
+        post = session.query(models.Post).get(1)
+        self.assertEqual(post.title, "Zebra")
+        self.assertEqual(post.body, "Just a test")
+        self.assertEqual(post.version, 2)
+
+        # The search index follows the new title
+        response = self.client.get("/api/posts?q=zebra",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual([post["id"] for post in json.loads(response.data)],
+                         [1])
+
+        # The old version can't be edited any more
+        response = self.client.patch("/api/posts/1",
+                                     data=json.dumps({"body": "Tits"}),
+                                     content_type="application/json",
+                                     headers=[("Accept", "application/json"),
+                                              ("If-Match", '"1-1"')],
+                                     )
+        self.assertEqual(response.status_code, 412)
+
+    def testPatchInvalidData(self):
+        """ Partial edits have to change something, and nothing unknown """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        session.add(postA)
+        session.commit()
+
+        for data in [{}, {"title": 32}, {"author": "Someone"}]:
+            response = self.client.patch(
+                "/api/posts/1",
+                data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")],
+            )
+            self.assertEqual(response.status_code, 422)
+
+        response = self.client.patch("/api/posts/2",
+                                     data=json.dumps({"title": "Zebra"}),
+                                     content_type="application/json",
+                                     headers=[("Accept", "application/json")],
+                                     )
+        self.assertEqual(response.status_code, 404)
+
+    def testGetPostsNotModified(self):
+        """ A client with the current list of posts gets a 304 """
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        etag = response.headers.get("ETag")
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 304)
+
+        # Deleting a post changes the list's ETag
+        self.client.delete("/api/posts/1",
+                           headers=[("Accept", "application/json")],
+                           )
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 1)
+
+    def testGetPostsPageNotModified(self):
+        """ A page's ETag comes from its own posts, with one query """
+        for i in range(3):
+            session.add(models.Post(title="Post {}".format(i), body="Body"))
+        session.commit()
+
+        # Once the total is cached only the page itself is read, after the
+        # check that the connection is alive
+        self.client.get("/api/posts?limit=1",
+                        headers=[("Accept", "application/json")],
+                        )
+        response = self.client.get("/api/posts?limit=1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.headers.get("X-Query-Count"), "2")
+        etag = response.headers.get("ETag")
+        response = self.client.get("/api/posts?limit=1",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 304)
+
+        # Editing a post on the page changes its ETag
+        self.client.put("/api/posts/1",
+                        data=json.dumps({"title": "New", "body": "Body"}),
+                        content_type="application/json",
+                        headers=[("Accept", "application/json")],
+                        )
+        response = self.client.get("/api/posts?limit=1",
+                                   headers=[("Accept", "application/json"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)[0]["title"], "New")
+
     def testDeletePost(self):
         """ Deleting a single post from a populated database """
         postA = models.Post(title="Example Post A", body="Just a test")
@@ -326,6 +1209,8 @@ class TestAPI(unittest.TestCase):
 
         data = json.loads(response.data)
         self.assertEqual(data["message"], "Could not find post with id 1")
+        # Nothing is kept in the cache about ids without a post
+        self.assertEqual(cache.get(written_key(1)), None)
 
     def testUnsupportedAcceptHeader(self):
         response = self.client.get("/api/posts",
@@ -339,9 +1224,20 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(data["message"],
                          "Request must accept application/json data")
 
+    def testSessionRemovedAfterRequest(self):
+        """ Each request gets a fresh session which is thrown away after """
+        session.add(models.Post(title="Example Post", body="Just a test"))
+        session.commit()
+        self.assertTrue(session.registry.has())
+
+        self.client.get("/api/posts", headers=[("Accept", "application/json")])
+
+        self.assertFalse(session.registry.has())
+
     def tearDown(self):
         """ Test teardown """
         session.close()
+        cache.clear()
         # Remove the tables and their data from the database
         Base.metadata.drop_all(engine)
 
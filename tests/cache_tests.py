@@ -0,0 +1,98 @@
+import unittest
+import os
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts.cache import LRUCache, SharedCache, LocalClient, NullCache
+
+
+class TestLRUCache(unittest.TestCase):
+    """ Tests for the in-process cache """
+
+    def testGetAndSet(self):
+        """ Values can be read back and misses of posts are counted """
+        cache = LRUCache(max_size=2, ttl=60)
+        self.assertEqual(cache.get("post:a"), None)
+        cache.set("post:a", "1")
+        self.assertEqual(cache.get("post:a"), "1")
+        # Bookkeeping isn't counted
+        self.assertEqual(cache.get("written:a"), None)
+        self.assertEqual(cache.stats(),
+                         {"hits": 1, "misses": 1, "evictions": 0, "size": 1})
+
+    def testEviction(self):
+        """ The least recently used value is evicted first """
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", "1")
+        cache.set("b", "2")
+        cache.get("a")
+        cache.set("c", "3")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), "1")
+        self.assertEqual(cache.get("c"), "3")
+        self.assertEqual(cache.evictions, 1)
+
+    def testExpiry(self):
+        """ Values are forgotten after the TTL """
+        cache = LRUCache(max_size=2, ttl=-1)
+        cache.set("a", "1")
+        self.assertEqual(cache.get("a"), None)
+
+    def testIncr(self):
+        """ Integers can be added to, but missing values aren't created """
+        cache = LRUCache(max_size=2, ttl=60)
+        self.assertEqual(cache.incr("a", 2), None)
+        self.assertEqual(cache.get("a"), None)
+        cache.set("a", 5)
+        self.assertEqual(cache.incr("a", -2), 3)
+        self.assertEqual(cache.get("a"), 3)
+
+    def testDelete(self):
+        """ Deleted values are gone """
+        cache = LRUCache(max_size=2, ttl=60)
+        cache.set("a", "1")
+        cache.delete("a")
+        self.assertEqual(cache.get("a"), None)
+
+
+class TestSharedCache(unittest.TestCase):
+    """ Tests for the shared cache with the local stand-in client """
+
+    def testSharedBetweenCaches(self):
+        """ Two caches on the same store see each other's writes """
+        client = LocalClient()
+        cacheA = SharedCache(client)
+        cacheB = SharedCache(client)
+        cacheA.set("post:a", "1")
+        self.assertEqual(cacheB.get("post:a"), "1")
+        cacheB.delete("post:a")
+        self.assertEqual(cacheA.get("post:a"), None)
+        self.assertEqual(cacheA.stats(),
+                         {"hits": 0, "misses": 1, "evictions": 0})
+
+    def testIncr(self):
+        """ Integers are added to in the store, and stay integers """
+        client = LocalClient()
+        cacheA = SharedCache(client)
+        cacheB = SharedCache(client)
+        self.assertEqual(cacheA.incr("a"), None)
+        cacheA.set("a", 5)
+        self.assertEqual(cacheB.incr("a", -1), 4)
+        self.assertEqual(cacheA.get("a"), 4)
+        # Strings of digits are still pickled like any other value
+        cacheA.set("b", "5")
+        self.assertEqual(cacheB.get("b"), "5")
+
+    def testPerProcess(self):
+        """ Only caches other processes can see are safe for many workers """
+        class Client(LocalClient):
+            per_process = False
+
+        self.assertTrue(LRUCache().per_process)
+        self.assertTrue(SharedCache(LocalClient()).per_process)
+        self.assertFalse(SharedCache(Client()).per_process)
+        self.assertFalse(NullCache().per_process)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,202 @@
+import unittest
+import os
+import gzip
+import json
+from io import BytesIO
+from StringIO import StringIO
+
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import models, compression
+from posts.database import Base, engine, session
+from posts.cache import cache
+
+
+def gzipped(data):
+    output = StringIO()
+    with gzip.GzipFile(fileobj=output, mode="wb") as f:
+        f.write(data)
+    return output.getvalue()
+
+
+def gunzipped(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class TestCompression(unittest.TestCase):
+    """ Tests for compressed responses and requests """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+
+        session.add_all([models.Post(title="Post {}".format(i),
+                                     body="Just a test " * 50)
+                         for i in range(10)])
+        session.commit()
+
+    def testCompressedList(self):
+        """ Large responses are gzipped for clients which accept it """
+        plain = self.client.get("/api/posts",
+                                headers=[("Accept", "application/json")],
+                                )
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip")],
+                                   )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertIn("Accept-Encoding", response.headers.get("Vary"))
+        self.assertTrue(len(response.data) < len(plain.data))
+        self.assertEqual(gunzipped(response.data), plain.data)
+
+        # The compressed ETag still works for conditional requests
+        etag = response.headers.get("ETag")
+        self.assertTrue(etag.endswith('-gzip"'))
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip"),
+                                            ("If-None-Match", etag)],
+                                   )
+        self.assertEqual(response.status_code, 304)
+        # And the 304 has the same ETag as the compressed response
+        self.assertEqual(response.headers.get("ETag"), etag)
+        self.assertIn("Accept-Encoding", response.headers.get("Vary"))
+
+    def testSmallResponseNotCompressed(self):
+        """ Responses under the size threshold are sent as they are """
+        response = self.client.get("/api/posts/12345",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip")],
+                                   )
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers.get("Content-Encoding"), None)
+
+    def testCompressedStream(self):
+        """ Streamed responses are compressed as they are sent """
+        plain = self.client.get("/api/posts",
+                                headers=[("Accept", "application/json")],
+                                )
+        response = self.client.get("/api/posts?stream=1",
+                                   headers=[("Accept", "application/json"),
+                                            ("Accept-Encoding", "gzip")],
+                                   )
+
+        self.assertEqual(response.headers.get("Content-Encoding"), "gzip")
+        self.assertEqual(gunzipped(response.data), plain.data)
+
+    def testCompressedRequest(self):
+        """ Posting a gzipped post """
+        data = json.dumps({"title": "Example Post", "body": "Just a test"})
+        response = self.client.post("/api/posts",
+                                    data=gzipped(data),
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json"),
+                                             ("Content-Encoding", "gzip")],
+                                    )
+
+        self.assertEqual(response.status_code, 201)
+        data = json.loads(response.data)
+        self.assertEqual(data["title"], "Example Post")
+        self.assertEqual(data["body"], "Just a test")
+
+    def testBrokenCompressedRequest(self):
+        """ Posting something which isn't really gzipped """
+        response = self.client.post("/api/posts",
+                                    data="{}",
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json"),
+                                             ("Content-Encoding", "gzip")],
+                                    )
+
+        self.assertEqual(response.status_code, 400)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"],
+                         "Request body is not valid gzip data")
+
+    def testChunkedCompressedImport(self):
+        """ Importing a gzipped body sent in chunks, with no length """
+        lines = "".join(json.dumps({"title": "Post {}".format(i),
+                                    "body": "Imported"}) + "\n"
+                        for i in range(2))
+        builder = EnvironBuilder("/api/posts/import", method="POST",
+                                 data=gzipped(lines),
+                                 content_type="application/x-ndjson",
+                                 headers=[("Accept", "application/json"),
+                                          ("Content-Encoding", "gzip")])
+        environ = builder.get_environ()
+        # The server says where a chunked body ends instead
+        del environ["CONTENT_LENGTH"]
+        environ["wsgi.input_terminated"] = True
+        body, status, headers = run_wsgi_app(app, environ, buffered=True)
+
+        self.assertEqual(status, "200 OK")
+        self.assertEqual(json.loads("".join(body))["imported"], 2)
+        self.assertEqual(session.query(models.Post).filter(
+            models.Post.body == "Imported").count(), 2)
+
+    def testCompressedRequestTooLarge(self):
+        """ Posting a gzipped body which decompresses to too much """
+        data = json.dumps({"title": "Example Post", "body": "a" * 1000})
+        max_size = app.wsgi_app.max_size
+        app.wsgi_app.max_size = 100
+        try:
+            response = self.client.post(
+                "/api/posts", data=gzipped(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json"),
+                         ("Content-Encoding", "gzip")],
+                )
+        finally:
+            app.wsgi_app.max_size = max_size
+
+        self.assertEqual(response.status_code, 413)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"],
+                         "Request body is too large once decompressed")
+
+    @unittest.skipIf("br" not in compression.DECOMPRESSORS,
+                     "brotli can't limit its output")
+    def testBrotliBomb(self):
+        """ Brotli bodies stop decompressing once they are too large """
+        def read(data, max_size):
+            return compression.DecompressedStream(BytesIO(data), "br",
+                                                  max_size).read()
+
+        brotli = compression.brotli
+        self.assertEqual(read(brotli.compress("abc"), 1000), "abc")
+        with self.assertRaises(compression.TooLarge):
+            read(brotli.compress("a" * 10000000), 1000)
+        with self.assertRaises(compression.InvalidData):
+            read(brotli.compress("a" * 10000)[:-2], 1000000)
+
+    def testUnsupportedEncoding(self):
+        """ Posting a body in an encoding we can't decompress """
+        response = self.client.post("/api/posts",
+                                    data="{}",
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json"),
+                                             ("Content-Encoding", "lzma")],
+                                    )
+
+        self.assertEqual(response.status_code, 415)
+        data = json.loads(response.data)
+        self.assertEqual(data["message"], "Unsupported content encoding lzma")
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        cache.clear()
+        # Remove the tables and their data from the database
+        Base.metadata.drop_all(engine)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import unittest
+import os
+import json
+import threading
+from urlparse import urlparse
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import models, group_commit
+from posts.database import Base, engine, session
+from posts.cache import cache
+
+
+class TestGroupCommit(unittest.TestCase):
+    """ Tests for committing writes from many requests together """
+
+    def setUp(self):
+        """ Test setup """
+        app.config.update(GROUP_COMMIT_ENABLED=True,
+                          GROUP_COMMIT_MAX_WAIT_MS=100)
+        group_commit.init_app(app)
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+
+    def sendAtOnce(self, requests):
+        """ Send (method, path, data, headers) requests from many threads """
+        responses = [None] * len(requests)
+
+        def send(i, method, path, data, headers):
+            responses[i] = app.test_client().open(
+                path, method=method, data=json.dumps(data),
+                content_type="application/json",
+                headers=[("Accept", "application/json")] + headers)
+        threads = [threading.Thread(target=send, args=(i,) + request)
+                   for i, request in enumerate(requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return responses
+
+    def testPostPosts(self):
+        """ Posts created at the same time are committed together """
+        responses = self.sendAtOnce([
+            ("POST", "/api/posts",
+             {"title": "Post {}".format(i), "body": "Just a test"}, [])
+            for i in range(10)])
+
+        self.assertEqual([response.status_code for response in responses],
+                         [201] * 10)
+        ids = set()
+        for i, response in enumerate(responses):
+            data = json.loads(response.data)
+            self.assertEqual(data["title"], "Post {}".format(i))
+            self.assertEqual(urlparse(response.headers.get("Location")).path,
+                             "/api/posts/{}".format(data["id"]))
+            self.assertEqual(response.headers.get("ETag"),
+                             '"{}-1"'.format(data["id"]))
+            ids.add(data["id"])
+        self.assertEqual(ids, set(range(1, 11)))
+        self.assertTrue(group_commit._committer.groups < 10)
+        self.assertEqual(group_commit._committer.writes, 10)
+        self.assertEqual(session.query(models.Post).count(), 10)
+
+    def testPutPosts(self):
+        """ Each edit in a group gets its own result """
+        session.add_all([models.Post(title="Post A", body="Just a test"),
+                         models.Post(title="Post B", body="Still a test")])
+        session.commit()
+
+        data = {"title": "New Titular", "body": "Tits"}
+        responses = self.sendAtOnce([
+            ("PUT", "/api/posts/1", data, []),
+            ("PUT", "/api/posts/2", data, [("If-Match", '"2-5"')]),
+            ("PUT", "/api/posts/3", data, [])])
+
+        self.assertEqual([response.status_code for response in responses],
+                         [200, 412, 404])
+        self.assertEqual(responses[0].headers.get("ETag"), '"1-2"')
+        titles = [title for title, in session.query(models.Post.title)
+                  .order_by(models.Post.id)]
+        self.assertEqual(titles, ["New Titular", "Post B"])
+
+    def tearDown(self):
+        """ Test teardown """
+        del app.config["GROUP_COMMIT_ENABLED"]
+        del app.config["GROUP_COMMIT_MAX_WAIT_MS"]
+        group_commit.init_app(app)
+        session.close()
+        cache.clear()
+        # Remove the tables and their data from the database
+        Base.metadata.drop_all(engine)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import os
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts.database import Base, engine, session
+
+
+class TestMetrics(unittest.TestCase):
+    """ Tests for the request instrumentation """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+
+    def testTimingHeaders(self):
+        """ Responses say how many queries they ran and where time went """
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")],
+                                   )
+
+        # The ETag summary and the list itself, plus any connection ping
+        self.assertTrue(int(response.headers.get("X-Query-Count")) >= 2)
+        timing = response.headers.get("Server-Timing")
+        self.assertIn("query;dur=", timing)
+        self.assertIn("serialize;dur=", timing)
+        self.assertIn("total;dur=", timing)
+
+    def testMetricsEndpoint(self):
+        """ The metrics endpoint reports on earlier requests """
+        self.client.get("/api/posts/1",
+                        headers=[("Accept", "application/json")],
+                        )
+        response = self.client.get("/metrics")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        lines = response.data.splitlines()
+        self.assertIn("# TYPE posts_request_duration_seconds histogram",
+                      lines)
+        self.assertTrue(any(
+            line.startswith('posts_request_duration_seconds_count{'
+                            'endpoint="api.post_get",method="GET",status="404"}')
+            for line in lines))
+        self.assertTrue(any(
+            line.startswith('posts_request_queries_count{'
+                            'endpoint="api.post_get"}')
+            for line in lines))
+        self.assertTrue(any(line.startswith("posts_cache_misses_total ")
+                            for line in lines))
+
+    def testProfile(self):
+        """ Asking for a profile swaps the body for a cProfile summary """
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json"),
+                                            ("X-Profile", "1")],
+                                   )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "text/plain")
+        self.assertEqual(response.headers.get("X-Profile"), "1")
+        self.assertIn("function calls", response.data)
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        # Remove the tables and their data from the database
+        Base.metadata.drop_all(engine)
+
+if __name__ == "__main__":
+    unittest.main()
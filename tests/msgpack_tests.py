@@ -0,0 +1,120 @@
+import unittest
+import os
+import json
+from urlparse import urlparse
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import app
+from posts import models
+from posts.database import Base, engine, session
+from posts.cache import cache
+
+
+@unittest.skipIf(msgpack is None, "msgpack isn't installed")
+class TestMsgpack(unittest.TestCase):
+    """ Tests for the MessagePack representation """
+
+    def setUp(self):
+        """ Test setup """
+        self.client = app.test_client()
+        # Set up the tables in the database
+        Base.metadata.create_all(engine)
+
+        postA = models.Post(title="Example Post A", body="Just a test")
+        postB = models.Post(title="Example Post B", body="Still a test")
+        session.add_all([postA, postB])
+        session.commit()
+
+    def testGetPost(self):
+        """ Getting a post as MessagePack """
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/msgpack")],
+                                   )
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, "application/msgpack")
+        post = msgpack.unpackb(response.data, raw=False)
+        self.assertEqual(post, {"id": 1, "title": "Example Post A",
+                                "body": "Just a test"})
+        self.assertEqual(response.headers.get("ETag"), '"1-1-msgpack"')
+
+        # The JSON copy in the cache isn't served to MessagePack clients
+        response = self.client.get("/api/posts/1",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.mimetype, "application/json")
+        self.assertEqual(json.loads(response.data)["id"], 1)
+
+    def testPreferredType(self):
+        """ The client's preference between the types is respected """
+        response = self.client.get(
+            "/api/posts",
+            headers=[("Accept",
+                      "application/json;q=0.5, application/msgpack")],
+        )
+
+        self.assertEqual(response.mimetype, "application/msgpack")
+        posts = msgpack.unpackb(response.data, raw=False)
+        self.assertEqual([post["title"] for post in posts],
+                         ["Example Post A", "Example Post B"])
+
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "*/*")],
+                                   )
+        self.assertEqual(response.mimetype, "application/json")
+
+    def testStreamPosts(self):
+        """ Streaming posts as a sequence of MessagePack objects """
+        response = self.client.get("/api/posts?stream=1",
+                                   headers=[("Accept", "application/msgpack")],
+                                   )
+
+        unpacker = msgpack.Unpacker(raw=False)
+        unpacker.feed(response.data)
+        self.assertEqual([post["title"] for post in unpacker],
+                         ["Example Post A", "Example Post B"])
+
+    def testPostPost(self):
+        """ Posting a new post as MessagePack """
+        data = msgpack.packb({"title": "Example Post", "body": "Just a test"})
+        response = self.client.post("/api/posts",
+                                    data=data,
+                                    content_type="application/msgpack",
+                                    headers=[("Accept", "application/msgpack")],
+                                    )
+
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(urlparse(response.headers.get("Location")).path,
+                         "/api/posts/3")
+        post = msgpack.unpackb(response.data, raw=False)
+        self.assertEqual(post["title"], "Example Post")
+
+    def testInvalidData(self):
+        """ Validation errors come back as MessagePack """
+        data = msgpack.packb({"title": "Example Post", "body": 32})
+        response = self.client.post("/api/posts",
+                                    data=data,
+                                    content_type="application/msgpack",
+                                    headers=[("Accept", "application/msgpack")],
+                                    )
+
+        self.assertEqual(response.status_code, 422)
+        data = msgpack.unpackb(response.data, raw=False)
+        self.assertEqual(data["message"], "32 is not of type 'string'")
+
+    def tearDown(self):
+        """ Test teardown """
+        session.close()
+        cache.clear()
+        # Remove the tables and their data from the database
+        Base.metadata.drop_all(engine)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+import posts
+from posts import create_app, models, database
+from posts.database import Base, session
+
+
+class TestReplicas(unittest.TestCase):
+    """ Tests for sending reads to replicas, with SQLite files standing in """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+
+        class ReplicaConfig(object):
+            DATABASE_URI = "sqlite:///{}/primary.db".format(self.directory)
+            DATABASE_REPLICA_URIS = [
+                "sqlite:///{}/replica.db".format(self.directory)]
+            DEBUG = True
+
+        self.app = create_app(ReplicaConfig)
+        self.client = self.app.test_client()
+        self.replica = database.get_replicas()[0]
+        # Set up the tables in both databases, with a post which the replica
+        # has an older copy of
+        for engine in [database.engine, self.replica]:
+            Base.metadata.create_all(engine)
+        session.add(models.Post(title="New title", body="Just a test"))
+        session.commit()
+        self.replica.execute(models.Post.__table__.insert(),
+                             title="Old title", body="Just a test")
+
+    def getTitle(self, client):
+        response = client.get("/api/posts/1",
+                              headers=[("Accept", "application/json")],
+                              )
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)["title"]
+
+    def testReadsFromReplica(self):
+        """ Reads go to the replica """
+        self.assertEqual(self.getTitle(self.client), "Old title")
+
+        response = self.client.get("/api/posts",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data)[0]["title"], "Old title")
+
+    def testReadYourWrites(self):
+        """ A client which has just written reads from the primary """
+        data = json.dumps({"title": "Newer title"})
+        response = self.client.patch("/api/posts/1",
+                                     data=data,
+                                     content_type="application/json",
+                                     headers=[("Accept", "application/json")],
+                                     )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("posts_primary_until=", response.headers["Set-Cookie"])
+
+        # Other clients still read the replica, but what they read isn't
+        # cached where the writer would see it
+        self.assertEqual(self.getTitle(self.app.test_client()), "Old title")
+        # The write went to the primary, and the writer sees it
+        self.assertEqual(self.getTitle(self.client), "Newer title")
+
+    def tearDown(self):
+        """ Test teardown """
+        session.remove()
+        database.dispose()
+        shutil.rmtree(self.directory)
+        # Put back the settings of the app the other tests use
+        posts.use_app(posts.app)
+
+if __name__ == "__main__":
+    unittest.main()
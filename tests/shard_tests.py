@@ -0,0 +1,172 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+import posts
+from posts import create_app, models, database
+from posts.database import Base, Session, session
+
+
+class TestShards(unittest.TestCase):
+    """ Tests for spreading posts across shards, with SQLite files """
+
+    def setUp(self):
+        """ Test setup """
+        self.directory = tempfile.mkdtemp()
+
+        class ShardConfig(object):
+            DATABASE_URI = "sqlite:///{}/main.db".format(self.directory)
+            DATABASE_SHARD_URIS = [
+                "sqlite:///{}/shard{}.db".format(self.directory, i)
+                for i in range(3)]
+            # Small blocks, so that several are reserved
+            DATABASE_ID_BLOCK_SIZE = 4
+            DEBUG = True
+
+        self.app = create_app(ShardConfig)
+        self.client = self.app.test_client()
+        self.shards = database.get_shards()
+        for engine in [database.engine] + self.shards:
+            Base.metadata.create_all(engine)
+
+    def addPost(self, title, body="Just a test"):
+        data = json.dumps({"title": title, "body": body})
+        response = self.client.post("/api/posts",
+                                    data=data,
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json")],
+                                    )
+        self.assertEqual(response.status_code, 201)
+        return json.loads(response.data)["id"]
+
+    def getList(self, query=""):
+        response = self.client.get("/api/posts" + query,
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        return response, json.loads(response.data)
+
+    def shardIds(self, shard):
+        shard_session = Session(info={"shard": shard})
+        try:
+            return [row[0] for row in shard_session.query(models.Post.id)]
+        finally:
+            shard_session.close()
+
+    def testPostsSpreadByHash(self):
+        """ Each post is stored once, on the shard its id hashes to """
+        ids = [self.addPost("Post #{}".format(i)) for i in range(12)]
+        self.assertEqual(ids, range(1, 13))
+
+        stored = []
+        for shard in self.shards:
+            shard_ids = self.shardIds(shard)
+            for id in shard_ids:
+                self.assertIs(database.shard_for(id), shard)
+            stored.extend(shard_ids)
+        self.assertEqual(sorted(stored), ids)
+        # Every shard got some of them
+        self.assertTrue(all(self.shardIds(shard) for shard in self.shards))
+
+    def testSinglePostRoutedById(self):
+        """ Reads, edits and deletes find the post on its shard """
+        ids = [self.addPost("Post #{}".format(i)) for i in range(6)]
+        id = ids[4]
+
+        data = json.dumps({"title": "Edited"})
+        response = self.client.patch("/api/posts/{}".format(id),
+                                     data=data,
+                                     content_type="application/json",
+                                     headers=[("Accept", "application/json")],
+                                     )
+        self.assertEqual(response.status_code, 200)
+
+        response = self.client.get("/api/posts/{}".format(id),
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["title"], "Edited")
+
+        response = self.client.delete("/api/posts/{}".format(id),
+                                      headers=[("Accept",
+                                                "application/json")],
+                                      )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(id, self.shardIds(database.shard_for(id)))
+
+        response = self.client.get("/api/posts/{}".format(id),
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(response.status_code, 404)
+
+    def testListMergedInIdOrder(self):
+        """ The list is gathered from every shard, in id order, and pages """
+        ids = [self.addPost("Post #{}".format(i)) for i in range(10)]
+
+        response, data = self.getList()
+        self.assertEqual([post["id"] for post in data], ids)
+        self.assertEqual(response.headers["X-Total-Count"], "10")
+
+        response, data = self.getList("?limit=4&after=3")
+        self.assertEqual([post["id"] for post in data], ids[3:7])
+        self.assertIn("after=7", response.headers["Link"])
+
+        response, data = self.getList("?stream=1&fields=title")
+        self.assertEqual([post["id"] for post in data], ids)
+
+        # The list's ETag covers every shard
+        response, data = self.getList("?fields=title")
+        etag = response.headers["ETag"]
+        headers = [("Accept", "application/json"), ("If-None-Match", etag)]
+        response = self.client.get("/api/posts?fields=title",
+                                   headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.addPost("Post #10")
+        response = self.client.get("/api/posts?fields=title",
+                                   headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)), 11)
+
+    def testSearchAcrossShards(self):
+        """ Search and filters fan out, and merge best matches first """
+        self.addPost("Apple", "Banana")
+        self.addPost("Apple", "Apple and banana")
+        self.addPost("Cherry", "Apple")
+        self.addPost("Cherry", "Cherry")
+
+        _, data = self.getList("?q=apple")
+        self.assertEqual([post["id"] for post in data], [2, 1, 3])
+
+        _, data = self.getList("?title_like=Cherry")
+        self.assertEqual([post["id"] for post in data], [3, 4])
+
+        response = self.client.get("/api/posts/count?q=banana",
+                                   headers=[("Accept", "application/json")],
+                                   )
+        self.assertEqual(json.loads(response.data)["count"], 2)
+
+    def testBatchNotSharded(self):
+        """ Batches need one database, so aren't available """
+        data = json.dumps({"delete": [1]})
+        response = self.client.post("/api/posts/batch",
+                                    data=data,
+                                    content_type="application/json",
+                                    headers=[("Accept", "application/json")],
+                                    )
+        self.assertEqual(response.status_code, 501)
+
+    def tearDown(self):
+        """ Test teardown """
+        session.remove()
+        database.dispose()
+        shutil.rmtree(self.directory)
+        # Put back the settings of the app the other tests use
+        posts.use_app(posts.app)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+import os
+
+import jsonschema
+
+# Configure our app to use the testing database
+os.environ["CONFIG_PATH"] = "posts.config.TestingConfig"
+
+from posts import api, validation
+
+
+class TestValidation(unittest.TestCase):
+    """ Tests for the precompiled validators """
+
+    def testSameErrors(self):
+        """ Errors match the ones jsonschema.validate raises """
+        for data in [{"title": "Example Post", "body": 32},
+                     {"title": "Example Post"},
+                     {"body": "Just a test"}]:
+            with self.assertRaises(jsonschema.ValidationError) as expected:
+                jsonschema.validate(data, api.post_schema)
+            with self.assertRaises(validation.ValidationError) as actual:
+                validation.validate(data, api.post_schema)
+            self.assertEqual(actual.exception.message,
+                             expected.exception.message)
+
+    def testCompiledOnce(self):
+        """ The same validator is reused for a schema """
+        self.assertIs(validation.compile_schema(api.post_schema),
+                      validation.compile_schema(api.post_schema))
+
+    def testInvalidSchema(self):
+        """ Broken schemas are rejected when they are compiled """
+        with self.assertRaises(jsonschema.SchemaError):
+            validation.compile_schema({"type": 12})
+
+if __name__ == "__main__":
+    unittest.main()